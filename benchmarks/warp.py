@@ -0,0 +1,66 @@
+"""Benchmark the engines used to reproject rasters.
+
+Warps ``data/spain.tiff`` from its native UTM projection into spherical mercator at several output sizes using each
+engine in :py:mod:`foldbeam.rendering.renderer.warp`. Run from the top-level directory:
+
+    $ python benchmarks/warp.py
+
+"""
+import os
+import timeit
+
+from osgeo import gdal, osr
+
+from foldbeam.rendering.renderer.decorator import spatial_reference_pair_cache
+from foldbeam.rendering.renderer.warp import ReprojectImageEngine, GDALWarpEngine, WarpGridEngine
+
+SIZES = (256, 512, 1024, 2048)
+
+def output_envelope(source_dataset, pair):
+    """Return the envelope (min_x, min_y, max_x, max_y) of *source_dataset* in the output spatial reference."""
+    x0, sx, _, y0, _, sy = source_dataset.GetGeoTransform()
+    x1, y1 = x0 + sx * source_dataset.RasterXSize, y0 + sy * source_dataset.RasterYSize
+    transform = osr.CoordinateTransformation(pair.native_spatial_reference, pair.spatial_reference)
+    corners = transform.TransformPoints([(x0, y0), (x1, y0), (x1, y1), (x0, y1)])
+    xs, ys = [c[0] for c in corners], [c[1] for c in corners]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def output_dataset(source_dataset, envelope, size):
+    min_x, min_y, max_x, max_y = envelope
+    driver = gdal.GetDriverByName('MEM')
+    dataset = driver.Create('', size, size, source_dataset.RasterCount, source_dataset.GetRasterBand(1).DataType)
+    dataset.SetGeoTransform((min_x, (max_x-min_x) / float(size), 0.0, max_y, 0.0, -(max_y-min_y) / float(size)))
+    return dataset
+
+def main():
+    path = os.path.join(os.path.dirname(__file__), '..', 'data', 'spain.tiff')
+    source_dataset = gdal.Open(path)
+    assert source_dataset is not None
+
+    native_srs = osr.SpatialReference()
+    native_srs.ImportFromWkt(source_dataset.GetProjection())
+    output_srs = osr.SpatialReference()
+    output_srs.ImportFromEPSG(3857)
+    pair = spatial_reference_pair_cache().get(output_srs, native_srs)
+    envelope = output_envelope(source_dataset, pair)
+
+    engines = [('ReprojectImage', ReprojectImageEngine())]
+    try:
+        engines.append(('Warp (1 thread)', GDALWarpEngine(num_threads=1)))
+        engines.append(('Warp (all CPUs)', GDALWarpEngine()))
+    except RuntimeError:
+        print('gdal.Warp is not available; skipping GDALWarpEngine')
+    engines.append(('warp grid', WarpGridEngine()))
+
+    for size in SIZES:
+        print('%sx%s output:' % (size, size))
+        for label, engine in engines:
+            for resampling_label, resampling in (('nearest', gdal.GRA_NearestNeighbour), ('bilinear', gdal.GRA_Bilinear)):
+                def warp():
+                    engine.warp(source_dataset, output_dataset(source_dataset, envelope, size), pair, resampling)
+                n = max(1, 1024 // size)
+                duration = min(timeit.repeat(warp, number=n, repeat=3))
+                print('  %-16s %-9s %8.2f ms/warp' % (label, resampling_label, 1e3 * duration / n))
+
+if __name__ == '__main__':
+    main()
@@ -13,11 +13,14 @@ import shutil
 import cairo
 import git
 import mapnik
-import numpy as np
 from PIL import Image
 from osgeo import ogr, osr, gdal
 from shove import Shove
 
+from foldbeam.rendering.renderer.buffer_pool import default_buffer_pool
+from foldbeam.rendering.renderer.decorator import spatial_reference_pair_cache
+from foldbeam.rendering.renderer.warp import default_warp_engine, read_into_image_surface
+
 log = logging.getLogger()
 
 class BadFileNameError(Exception):
@@ -82,6 +85,12 @@ class Layer(object):
         raise NotImplementedError   # pragma: no coverage
 
 class _GDALLayer(object):
+    # the engine from foldbeam.rendering.renderer.warp used to reproject tiles or None for the default
+    warp_engine = None
+
+    # the pool of output datasets and surfaces or None for the process-wide pool
+    buffer_pool = None
+
     def __init__(self, ds, ds_path, bucket, temp_repo):
         self.name = os.path.basename(ds_path)
         self.type = Layer.RASTER_TYPE
@@ -102,41 +111,37 @@ class _GDALLayer(object):
         # get the input dataset
         input_dataset = self._dataset
 
-        input_srs_wkt = input_dataset.GetProjection()
-        if input_srs_wkt is None or input_srs_wkt == '':
+        if self.spatial_reference is None:
             return None
 
-        # create an output dataset
-        driver = gdal.GetDriverByName('MEM')
-        assert driver is not None
-        output_dataset = driver.Create('', tile_size[0], tile_size[1], 4, gdal.GDT_Byte)
-        assert output_dataset is not None
+        # get an output dataset
+        buffer_pool = self.buffer_pool or default_buffer_pool()
+        output_dataset = buffer_pool.acquire_mem_dataset(tile_size[0], tile_size[1], 4, gdal.GDT_Byte)
         output_dataset.SetGeoTransform((
             tile_box[0], float(tile_box[2]-tile_box[0])/float(tile_size[0]), 0.0,
             tile_box[3], 0.0, -float(tile_box[3]-tile_box[1])/float(tile_size[1])
         ))
 
-        # project input into output
-        gdal.ReprojectImage(
-                input_dataset, output_dataset,
-                input_srs_wkt, srs.ExportToWkt(),
-                gdal.GRA_NearestNeighbour
-        )
-
-        # create a cairo image surface for the output. This unfortunately necessitates a copy since the in-memory format
-        # for a GDAL Dataset is not interleaved.
-        output_array = np.transpose(output_dataset.ReadAsArray(), (1,2,0))
-
-        # swizzle RGBA -> BGRA for Cairo
-        output_array = output_array[:,:,(2,1,0,3)]
-
-        output_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, tile_size[0], tile_size[1])
-        surface_array = np.frombuffer(output_surface.get_data(), dtype=np.uint8)
-        surface_array[:] = output_array.flat
-        output_surface.mark_dirty()
-
-        ctx.set_source_surface(output_surface)
-        ctx.paint()
+        output_surface = None
+        try:
+            # project input into output
+            pair = spatial_reference_pair_cache().get(srs, self.spatial_reference)
+            warp_engine = self.warp_engine or default_warp_engine()
+            warp_engine.warp(input_dataset, output_dataset, pair, gdal.GRA_NearestNeighbour)
+
+            # read the RGBA output into a cairo image surface in its BGRA order
+            output_surface = buffer_pool.acquire_image_surface(tile_size[0], tile_size[1])
+            read_into_image_surface(output_dataset, output_surface, (3, 2, 1, 4))
+
+            # the source is restored so that the context does not keep a reference to the pooled surface
+            ctx.save()
+            ctx.set_source_surface(output_surface)
+            ctx.paint()
+            ctx.restore()
+        finally:
+            buffer_pool.release_mem_dataset(output_dataset)
+            if output_surface is not None:
+                buffer_pool.release_image_surface(output_surface)
 
 class _OGRLayer(object):
     def __init__(self, layer, datasource, bucket, temp_repo):
@@ -3,7 +3,55 @@
 represented by tiles between spatial references.
 """
 
+import collections
+from contextlib import contextmanager
+import threading
+
+import numpy as np
 from osgeo import ogr, gdal
+import pyproj
+
+from foldbeam.rendering.srs import spatial_reference_registry
+
+_global_partial_reprojection_lock = threading.Lock()
+_global_partial_reprojection_users = 0
+_global_partial_reprojection_old_value = None
+
+@contextmanager
+def partial_reprojection():
+    """A context manager which enables the ``OGR_ENABLE_PARTIAL_REPROJECTION`` GDAL configuration option for the
+    calling thread. Within it, transforming a geometry some of whose points cannot be projected drops those points
+    rather than failing outright. It is safe to use from many threads at once.
+
+    Where GDAL supports it, the option is set only for the calling thread. Otherwise, the option is set globally for as
+    long as any thread is within the context manager and the previous value is restored when the last thread leaves.
+
+    """
+    if hasattr(gdal, 'SetThreadLocalConfigOption'):
+        if hasattr(gdal, 'GetThreadLocalConfigOption'):
+            old_value = gdal.GetThreadLocalConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION', None)
+        else:
+            old_value = None
+        gdal.SetThreadLocalConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION', 'TRUE')
+        try:
+            yield
+        finally:
+            gdal.SetThreadLocalConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION', old_value)
+        return
+
+    global _global_partial_reprojection_users, _global_partial_reprojection_old_value
+    with _global_partial_reprojection_lock:
+        if _global_partial_reprojection_users == 0:
+            _global_partial_reprojection_old_value = gdal.GetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION')
+            gdal.SetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION', 'TRUE')
+        _global_partial_reprojection_users += 1
+    try:
+        yield
+    finally:
+        with _global_partial_reprojection_lock:
+            _global_partial_reprojection_users -= 1
+            if _global_partial_reprojection_users == 0:
+                gdal.SetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION', _global_partial_reprojection_old_value)
 
 def boundary_from_envelope(envelope):
     """Construct a :py:class:`Boundary` from an :py:class:`Envelope`. The boundary is the bounding box which encloses
@@ -14,18 +62,122 @@ def boundary_from_envelope(envelope):
 
     """
 
+    left, right, top, bottom = ['%f' % x for x in (envelope.left, envelope.right, envelope.top, envelope.bottom)]
     wkt = 'POLYGON ((%s))' % (
-            ','.join(['%f %f' % x for x in [
-                (envelope.left,envelope.top),
-                (envelope.right,envelope.top),
-                (envelope.right,envelope.bottom),
-                (envelope.left,envelope.bottom),
-                (envelope.left,envelope.top)
+            ','.join(['%s %s' % x for x in [
+                (left,top),
+                (right,top),
+                (right,bottom),
+                (left,bottom),
+                (left,top)
             ]]),
     )
     geom = ogr.CreateGeometryFromWkt(wkt)
     geom.AssignSpatialReference(envelope.spatial_reference)
-    return Boundary(geom)
+    boundary = Boundary(geom)
+
+    # the boundary is entirely determined by the formatted co-ordinates and so they identify its transformations
+    boundary._envelope_key = (left, right, top, bottom)
+    return boundary
+
+def transform_envelopes(envelopes, spatial_reference, other_spatial_reference, src_seg_len=None):
+    """Transform many envelopes from one spatial reference to another at once. This is the vectorised equivalent of
+    calling :py:meth:`Envelope.transform_to` for each envelope in turn.
+
+    The edges of each envelope are densified so that no segment is longer than *src_seg_len* and the points along them
+    transformed in a single call to :py:mod:`pyproj`. As with :py:meth:`ogr.Geometry.Segmentize`, each edge is split
+    into as few equal segments as its own length requires, so small envelopes in a batch with large ones cost little
+    and the points transformed are those :py:meth:`Envelope.transform_to` would transform. Points which cannot be
+    transformed are
+    ignored, as in :py:meth:`Boundary.transform_to`. If no point of an envelope can be transformed, its row in the
+    result is NaN.
+
+    :param envelopes: the envelopes to transform, one per row, as (left, right, top, bottom)
+    :type envelopes: numpy array with shape (N, 4)
+    :param spatial_reference: the source spatial reference
+    :type spatial_reference: :py:class:`osr.SpatialReference`
+    :param other_spatial_reference: the destination spatial reference
+    :type other_spatial_reference: :py:class:`osr.SpatialReference`
+    :param src_seg_len: the maximum length of an envelope edge segment in the source spatial reference or `None` to
+        transform only the corners
+    :type src_seg_len: float or None
+    :rtype: numpy array with shape (N, 4) giving (left, right, top, bottom) for each transformed envelope
+
+    """
+    envelopes = np.asarray(envelopes, dtype=np.float64).reshape((-1, 4))
+    if envelopes.shape[0] == 0:
+        return envelopes.copy()
+    left, right, top, bottom = envelopes.T
+
+    # the number of segments the horizontal and vertical edges of each envelope are split into
+    n_x = np.ones(envelopes.shape[0], dtype=np.intp)
+    n_y = np.ones(envelopes.shape[0], dtype=np.intp)
+    if src_seg_len is not None:
+        n_x = np.maximum(1, np.ceil(np.abs(right - left) / float(src_seg_len))).astype(np.intp)
+        n_y = np.maximum(1, np.ceil(np.abs(top - bottom) / float(src_seg_len))).astype(np.intp)
+
+    # points around the perimeter of each envelope, top, right, bottom and then left edge, with the points of envelope
+    # i starting at offsets[i]
+    n_points = 2 * (n_x + n_y)
+    offsets = np.concatenate(([0], np.cumsum(n_points)[:-1]))
+    envelope_idx = np.repeat(np.arange(envelopes.shape[0]), n_points)
+    point_idx = np.arange(envelope_idx.shape[0]) - offsets[envelope_idx]
+    n_x, n_y = n_x[envelope_idx], n_y[envelope_idx]
+    edge = (point_idx >= n_x).astype(np.intp) + (point_idx >= n_x + n_y) + (point_idx >= 2 * n_x + n_y)
+    edge_start = np.choose(edge, (0, n_x, n_x + n_y, 2 * n_x + n_y))
+    t = (point_idx - edge_start) / np.choose(edge, (n_x, n_y, n_x, n_y)).astype(np.float64)
+
+    left, right, top, bottom = [v[envelope_idx] for v in (left, right, top, bottom)]
+    width, height = right - left, bottom - top
+    xs = np.choose(edge, (left + t * width, right, right - t * width, left))
+    ys = np.choose(edge, (top, top + t * height, bottom, bottom - t * height))
+
+    out_xs, out_ys = _transform_points(spatial_reference, other_spatial_reference, xs, ys)
+
+    # ignore points which could not be transformed
+    invalid = ~np.isfinite(out_xs) | ~np.isfinite(out_ys) | (np.abs(out_xs) > 1e30) | (np.abs(out_ys) > 1e30)
+    out_xs[invalid] = np.nan
+    out_ys[invalid] = np.nan
+
+    # fmin and fmax ignore NaNs unless every point of an envelope is NaN
+    return np.column_stack((
+        np.fmin.reduceat(out_xs, offsets), np.fmax.reduceat(out_xs, offsets),
+        np.fmax.reduceat(out_ys, offsets), np.fmin.reduceat(out_ys, offsets)))
+
+_transformers = threading.local()
+
+# the maximum number of transformers cached by each thread
+_MAX_TRANSFORMERS = 32
+
+def _transform_points(spatial_reference, other_spatial_reference, xs, ys):
+    """Transform the arrays of co-ordinates *xs* and *ys* between spatial references with :py:mod:`pyproj`. The
+    transformer for each pair of spatial references is built from their WKT, so that datum transformations are kept,
+    and the most recently used transformers are cached for the calling thread.
+
+    """
+    # registry keys are the canonical WKT of each spatial reference
+    registry = spatial_reference_registry()
+    key = (registry.key(spatial_reference), registry.key(other_spatial_reference))
+    cache = getattr(_transformers, 'cache', None)
+    if cache is None:
+        cache = _transformers.cache = collections.OrderedDict()
+
+    transform = cache.pop(key, None)
+    if transform is None:
+        if hasattr(pyproj, 'Transformer'):
+            transform = pyproj.Transformer.from_crs(
+                    pyproj.CRS.from_wkt(key[0]), pyproj.CRS.from_wkt(key[1]), always_xy=True).transform
+        else:
+            # versions of pyproj before 2.0 only understand PROJ.4 definitions
+            src_proj = pyproj.Proj(spatial_reference.ExportToProj4())
+            dst_proj = pyproj.Proj(other_spatial_reference.ExportToProj4())
+            transform = lambda xs, ys: pyproj.transform(src_proj, dst_proj, xs, ys)
+        while len(cache) >= _MAX_TRANSFORMERS:
+            cache.popitem(last=False)
+    cache[key] = transform
+
+    out_xs, out_ys = transform(xs, ys)
+    return np.asarray(out_xs, dtype=np.float64), np.asarray(out_ys, dtype=np.float64)
 
 class ProjectionError(RuntimeError):
     """Error raised when projection from one spatial reference to another has failed.
@@ -61,6 +213,9 @@ class Boundary(object):
 
         self.geometry = geometry
 
+        # set by boundary_from_envelope to allow transformations of this boundary to be cached
+        self._envelope_key = None
+
     @property
     def wkt(self):
         return self.geometry.ExportToWkt()
@@ -98,6 +253,47 @@ class Boundary(object):
         point.AddPoint_2D(x, y)
         return self.geometry.Contains(point)
 
+    def contains_points(self, xs, ys):
+        """Test many points at once for containment within this boundary. This is the vectorised equivalent of
+        calling :py:meth:`contains_point` for each point.
+
+        Containment is tested by casting a ray from each point and counting the boundary edges it crosses. Points lying
+        exactly on the boundary may be reported as either inside or outside.
+
+        :param xs: the points' x-co-ordinates
+        :type xs: array-like
+        :param ys: the points' y-co-ordinates
+        :type ys: array-like
+        :rtype: numpy boolean array with the same shape as *xs* which is True where a point is within the boundary
+
+        """
+        xs, ys = np.broadcast_arrays(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        mask = np.zeros(xs.shape, dtype=np.bool_)
+
+        # only points within the boundary's envelope need testing against its edges
+        min_x, max_x, min_y, max_y = self.geometry.GetEnvelope()
+        candidates = np.nonzero(((xs >= min_x) & (xs <= max_x) & (ys >= min_y) & (ys <= max_y)).ravel())[0]
+        if candidates.shape[0] == 0:
+            return mask
+        candidate_xs, candidate_ys = xs.ravel()[candidates], ys.ravel()[candidates]
+
+        inside = np.zeros(candidates.shape, dtype=np.bool_)
+        for rings in _polygon_rings(self.geometry):
+            # a point is inside a polygon if a ray from it crosses the polygon's rings an odd number of times
+            polygon_inside = np.zeros(candidates.shape, dtype=np.bool_)
+            for ring in rings:
+                for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+                    crosses = (y1 > candidate_ys) != (y2 > candidate_ys)
+                    if not np.any(crosses):
+                        continue
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        intersect_xs = x1 + (candidate_ys - y1) * (x2 - x1) / (y2 - y1)
+                    polygon_inside ^= crosses & (candidate_xs < intersect_xs)
+            inside |= polygon_inside
+
+        mask.ravel()[candidates] = inside
+        return mask
+
     def transform_to(self, other_spatial_reference, src_seg_len=None, dst_seg_len=None):
         """Transform this boundary into another spatial reference.
 
@@ -119,23 +315,40 @@ class Boundary(object):
         If *dst_seg_len* is not None, it specifies the maximum length in the destination spatial reference used to
         simplify the transformed boundary. If known, set this to the approximate length of a pixel in the destination
         spatial reference.
+
+        Transformations of boundaries constructed by :py:func:`boundary_from_envelope` are memoised by the
+        :py:class:`BoundaryTransformCache` returned by :py:func:`boundary_transform_cache`.
         
         """
 
+        # boundaries without a spatial reference fail to transform below and so are never cached
+        cache_key = None
+        if self._envelope_key is not None and self.geometry.GetSpatialReference() is not None \
+                and other_spatial_reference is not None:
+            registry = spatial_reference_registry()
+            cache_key = (
+                    self._envelope_key,
+                    registry.key(self.geometry.GetSpatialReference()), registry.key(other_spatial_reference),
+                    src_seg_len, dst_seg_len)
+            geom = _boundary_transform_cache.get(cache_key)
+            if geom is not None:
+                return Boundary(geom.Clone())
+
         geom = self.geometry.Clone()
         if src_seg_len is not None:
             geom.Segmentize(float(src_seg_len))
 
-        old_opt = gdal.GetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION')
-        gdal.SetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION', 'TRUE')
-        err = geom.TransformTo(other_spatial_reference)
-        gdal.SetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION', old_opt)
+        with partial_reprojection():
+            err = geom.TransformTo(other_spatial_reference)
         if err != 0:
             raise ProjectionError('Unable to project boundary into target projection (%s).' % (err,))
 
         if dst_seg_len is not None and hasattr(geom, 'Simplify'):
             geom.Simplify(dst_seg_len)
 
+        if cache_key is not None:
+            _boundary_transform_cache.put(cache_key, geom.Clone())
+
         return Boundary(geom)
 
     def __str__(self):
@@ -144,6 +357,95 @@ class Boundary(object):
     def __repr__(self):
         return 'Boundary(%s, %s)' % (self.geometry, self.geometry.GetSpatialReference().ExportToWkt())
 
+class BoundaryTransformCache(object):
+    """A thread-safe least-recently-used cache of transformed boundary geometries used by
+    :py:meth:`Boundary.transform_to`.
+
+    Entries are keyed by the co-ordinates of the envelope the boundary was constructed from, as formatted by
+    :py:func:`boundary_from_envelope`, the keys of the source and destination spatial references from
+    :py:func:`foldbeam.rendering.srs.spatial_reference_registry` and the segment lengths.
+
+    :param max_entries: default 1024, the maximum number of transformed boundaries to remember
+    :type max_entries: integer
+
+    .. py:attribute:: hits
+
+        The number of calls to :py:meth:`get` which found a transformed boundary.
+
+    .. py:attribute:: misses
+
+        The number of calls to :py:meth:`get` which did not find a transformed boundary.
+
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or 1024
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._geometries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def get(self, key):
+        """Return the geometry cached for *key* or `None` if there is none. The geometry must not be modified."""
+        with self._lock:
+            geometry = self._geometries.pop(key, None)
+            if geometry is None:
+                self.misses += 1
+                return None
+            self._geometries[key] = geometry
+            self.hits += 1
+            return geometry
+
+    def put(self, key, geometry):
+        """Cache *geometry* under *key*, evicting the least recently used geometries if necessary."""
+        with self._lock:
+            self._geometries.pop(key, None)
+            while len(self._geometries) >= self.max_entries:
+                self._geometries.popitem(last=False)
+            self._geometries[key] = geometry
+
+    def clear(self):
+        """Discard all cached geometries and reset the hit and miss counters."""
+        with self._lock:
+            self._geometries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return a dictionary giving the *hits*, *misses*, *hit_rate* and number of *entries* of this cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._geometries),
+                    hit_rate=float(self.hits) / lookups if lookups > 0 else 0.0)
+
+_boundary_transform_cache = BoundaryTransformCache()
+
+def boundary_transform_cache():
+    """Return the process-wide :py:class:`BoundaryTransformCache` used by :py:meth:`Boundary.transform_to`."""
+    return _boundary_transform_cache
+
+def _polygon_rings(geometry):
+    """Yield, for each polygon within the OGR *geometry*, a list of its rings as sequences of (x, y) tuples. Each ring
+    is closed, with the first point repeated at the end.
+
+    """
+    geometry_type = ogr.GT_Flatten(geometry.GetGeometryType())
+    if geometry_type == ogr.wkbPolygon:
+        rings = []
+        for ring_idx in xrange(geometry.GetGeometryCount()):
+            points = [p[:2] for p in geometry.GetGeometryRef(ring_idx).GetPoints() or []]
+            if len(points) > 0 and points[0] != points[-1]:
+                points.append(points[0])
+            rings.append(points)
+        yield rings
+    elif geometry_type in (ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+        for geometry_idx in xrange(geometry.GetGeometryCount()):
+            for rings in _polygon_rings(geometry.GetGeometryRef(geometry_idx)):
+                yield rings
+
 class Envelope(object):
     """An axis-aligned bounding box in a particular spatial reference.
 
@@ -154,6 +456,8 @@ class Envelope(object):
 
     """
 
+    __slots__ = ('left', 'right', 'top', 'bottom', 'spatial_reference')
+
     def __init__(self, left, right, top, bottom, spatial_reference):
         self.left = left
         self.right = right
@@ -208,3 +512,164 @@ class Envelope(object):
 
     def __str__(self):
         return '(%f => %f, %f => %f)' % (self.left, self.right, self.top, self.bottom)
+
+class EnvelopeArray(object):
+    """Many axis-aligned bounding boxes sharing a single spatial reference.
+
+    The envelopes are held in one contiguous N x 4 array of float64 with columns giving the left, right, top and
+    bottom co-ordinates, in the same order as the parameters to :py:class:`Envelope`. Operations on an envelope array
+    are vectorised and so work on large numbers of envelopes without creating a Python object for each.
+
+    As with :py:class:`Envelope`, the left co-ordinate need not be less than the right nor the top greater than the
+    bottom. Envelopes returned by :py:meth:`intersection` and :py:meth:`union` are normalised so that left <= right and
+    bottom <= top, as are those from :py:meth:`Boundary.envelope`.
+
+    Operations taking another envelope or envelope array broadcast: *other* may be a single :py:class:`Envelope`, an
+    envelope array of length one or an envelope array of the same length as this one. The other envelopes are assumed
+    to be in the same spatial reference.
+
+    :param array: the envelopes
+    :type array: array-like with shape (N, 4)
+    :param spatial_reference: the spatial reference shared by all the envelopes
+
+    .. py:attribute:: array
+
+        The underlying N x 4 array.
+
+    """
+
+    __slots__ = ('array', 'spatial_reference')
+
+    def __init__(self, array, spatial_reference):
+        self.array = np.ascontiguousarray(array, dtype=np.float64).reshape((-1, 4))
+        self.spatial_reference = spatial_reference
+
+    @classmethod
+    def from_envelopes(cls, envelopes, spatial_reference=None):
+        """Construct an envelope array from a sequence of :py:class:`Envelope` instances. If *spatial_reference* is
+        `None`, the spatial reference of the first envelope is used.
+
+        """
+        envelopes = list(envelopes)
+        if spatial_reference is None and len(envelopes) > 0:
+            spatial_reference = envelopes[0].spatial_reference
+        return cls([(e.left, e.right, e.top, e.bottom) for e in envelopes], spatial_reference)
+
+    @classmethod
+    def grid(cls, envelope, n_x, n_y):
+        """Construct an envelope array by dividing *envelope* into *n_x* by *n_y* equally sized cells. The cells are
+        ordered row by row from the top-left, and so cell (x, y) is at index ``y * n_x + x``.
+
+        """
+        xs = np.linspace(envelope.left, envelope.right, n_x + 1)
+        ys = np.linspace(envelope.top, envelope.bottom, n_y + 1)
+        array = np.empty((n_y, n_x, 4), dtype=np.float64)
+        array[:,:,0] = xs[np.newaxis,:-1]
+        array[:,:,1] = xs[np.newaxis,1:]
+        array[:,:,2] = ys[:-1,np.newaxis]
+        array[:,:,3] = ys[1:,np.newaxis]
+        return cls(array.reshape((-1, 4)), envelope.spatial_reference)
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, index):
+        """An integer index returns an :py:class:`Envelope`. Any other index, such as a slice or boolean mask, returns
+        an :py:class:`EnvelopeArray`.
+
+        """
+        if isinstance(index, (int, long, np.integer)):
+            left, right, top, bottom = self.array[index]
+            return Envelope(left, right, top, bottom, self.spatial_reference)
+        return EnvelopeArray(self.array[index], self.spatial_reference)
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    @property
+    def left(self):
+        return self.array[:,0]
+
+    @property
+    def right(self):
+        return self.array[:,1]
+
+    @property
+    def top(self):
+        return self.array[:,2]
+
+    @property
+    def bottom(self):
+        return self.array[:,3]
+
+    def area(self):
+        """Return an array giving the area of each envelope."""
+        return np.abs(self.right - self.left) * np.abs(self.top - self.bottom)
+
+    def intersects(self, other):
+        """Return a boolean array which is True where an envelope overlaps the corresponding one in *other*."""
+        min_x, max_x, min_y, max_y = _bounds(self)
+        other_min_x, other_max_x, other_min_y, other_max_y = _bounds(other)
+        return (min_x <= other_max_x) & (other_min_x <= max_x) & (min_y <= other_max_y) & (other_min_y <= max_y)
+
+    def contains(self, other):
+        """Return a boolean array which is True where an envelope entirely contains the corresponding one in *other*."""
+        min_x, max_x, min_y, max_y = _bounds(self)
+        other_min_x, other_max_x, other_min_y, other_max_y = _bounds(other)
+        return (min_x <= other_min_x) & (other_max_x <= max_x) & (min_y <= other_min_y) & (other_max_y <= max_y)
+
+    def intersection(self, other):
+        """Return an :py:class:`EnvelopeArray` giving the intersection of each envelope with the corresponding one in
+        *other*. Where the two do not intersect, the result is NaN.
+
+        """
+        min_x, max_x, min_y, max_y = _bounds(self)
+        other_min_x, other_max_x, other_min_y, other_max_y = _bounds(other)
+        result = np.column_stack(np.broadcast_arrays(
+            np.maximum(min_x, other_min_x), np.minimum(max_x, other_max_x),
+            np.minimum(max_y, other_max_y), np.maximum(min_y, other_min_y)))
+        result[(result[:,0] > result[:,1]) | (result[:,3] > result[:,2])] = np.nan
+        return EnvelopeArray(result, self.spatial_reference)
+
+    def union(self, other):
+        """Return an :py:class:`EnvelopeArray` giving the smallest envelope containing each envelope and the
+        corresponding one in *other*.
+
+        """
+        min_x, max_x, min_y, max_y = _bounds(self)
+        other_min_x, other_max_x, other_min_y, other_max_y = _bounds(other)
+        return EnvelopeArray(np.column_stack(np.broadcast_arrays(
+            np.minimum(min_x, other_min_x), np.maximum(max_x, other_max_x),
+            np.maximum(max_y, other_max_y), np.minimum(min_y, other_min_y))), self.spatial_reference)
+
+    def bounds(self):
+        """Return the smallest :py:class:`Envelope` containing every envelope in this array."""
+        min_x, max_x, min_y, max_y = _bounds(self)
+        return Envelope(min_x.min(), max_x.max(), max_y.max(), min_y.min(), self.spatial_reference)
+
+    def transform_to(self, other_spatial_reference, src_seg_len=None):
+        """Return an :py:class:`EnvelopeArray` containing each envelope in a target spatial reference. See
+        :py:func:`transform_envelopes`.
+
+        """
+        return EnvelopeArray(
+                transform_envelopes(self.array, self.spatial_reference, other_spatial_reference, src_seg_len),
+                other_spatial_reference)
+
+    def __repr__(self):
+        return 'EnvelopeArray(%r)' % (self.array,)
+
+def _bounds(envelopes):
+    """Return arrays of the minimum x, maximum x, minimum y and maximum y of an :py:class:`Envelope` or
+    :py:class:`EnvelopeArray`.
+
+    """
+    if isinstance(envelopes, Envelope):
+        array = np.array([[envelopes.left, envelopes.right, envelopes.top, envelopes.bottom]], dtype=np.float64)
+    else:
+        array = envelopes.array
+    return (
+        np.minimum(array[:,0], array[:,1]), np.maximum(array[:,0], array[:,1]),
+        np.minimum(array[:,2], array[:,3]), np.maximum(array[:,2], array[:,3]),
+    )
@@ -4,6 +4,8 @@ from osgeo import ogr
 import shapely.wkb
 from geoalchemy.base import WKBSpatialElement, WKTSpatialElement
 
+from foldbeam.rendering.srs import spatial_reference_registry
+
 def reproject_from_native_spatial_reference(f):
 
     @wraps(f)
@@ -12,7 +14,8 @@ def reproject_from_native_spatial_reference(f):
         native_spatial_reference = self.native_spatial_reference
 
         # If no spatial reference was specified, or if it matches the native one, just render directly
-        if native_spatial_reference is None or spatial_reference is None or spatial_reference.IsSame(native_spatial_reference):
+        if native_spatial_reference is None or spatial_reference is None or \
+                spatial_reference_registry().is_same(spatial_reference, native_spatial_reference):
             return f(self, boundary, spatial_reference=native_spatial_reference, **kwargs)
 
         def reproj(g):
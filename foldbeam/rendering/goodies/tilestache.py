@@ -1,11 +1,11 @@
 """Support for using a renderer as a provider with TileStache for serving slippy map tiles.
 """
 import cairo
-from osgeo.osr import SpatialReference
 from PIL import Image
 import TileStache
 
 from foldbeam.rendering.renderer import TileFetcher, set_geo_transform
+from foldbeam.rendering.srs import spatial_reference_registry
 
 class TileStacheProvider(object):
     """An object suitable for use as a TileStache provider.
@@ -19,14 +19,12 @@ class TileStacheProvider(object):
         self.renderer = TileFetcher()
 
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
-        spatial_reference = SpatialReference()
-
         # this is a special HACK to take account of the fact that the proj4 srs provided by TileStache has the +over
         # parameter and OGR thinks it is different to EPSG:3857
         if srs == TileStache.Geography.SphericalMercator.srs:
-            spatial_reference.ImportFromEPSG(3857)
+            spatial_reference = spatial_reference_registry().from_epsg(3857)
         else:
-            spatial_reference.ImportFromProj4(srs)
+            spatial_reference = spatial_reference_registry().from_proj4(srs)
 
         surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
         cr = cairo.Context(surface)
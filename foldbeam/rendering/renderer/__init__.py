@@ -4,6 +4,11 @@ This module also imports all sub-module members as a convenience.
 """
 
 from foldbeam.rendering.renderer.base import *
+from foldbeam.rendering.renderer.buffer_pool import *
 from foldbeam.rendering.renderer.decorator import *
+from foldbeam.rendering.renderer.fetch import *
+from foldbeam.rendering.renderer.mbtiles import *
 from foldbeam.rendering.renderer.geometry import *
+from foldbeam.rendering.renderer.tile_cache import *
 from foldbeam.rendering.renderer.tile_fetcher import *
+from foldbeam.rendering.renderer.warp import *
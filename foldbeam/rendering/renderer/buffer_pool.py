@@ -0,0 +1,152 @@
+"""A pool of reusable buffers for the stages of reprojecting a raster.
+
+"""
+import collections
+import logging
+import threading
+
+import cairo
+from osgeo import gdal
+
+log = logging.getLogger()
+
+class BufferPool(object):
+    """A thread-safe pool of idle buffers, such as Cairo image surfaces and GDAL MEM datasets, keyed by their kind and
+    size.
+
+    A buffer is taken from the pool with :py:meth:`acquire` and handed back with :py:meth:`release` once its user has
+    finished with it. If there is no idle buffer for a key, :py:meth:`acquire` creates one. Buffers are *not* cleared
+    by the pool and so may hold data from their previous use.
+
+    The pool is bounded by the total number of bytes held by idle buffers. When releasing a buffer would exceed the
+    budget, the least recently released buffers are discarded until it fits.
+
+    :param max_bytes: default 64MiB, the maximum number of bytes held by idle buffers
+    :type max_bytes: integer
+
+    .. py:attribute:: hits
+
+        The number of calls to :py:meth:`acquire` which reused an idle buffer.
+
+    .. py:attribute:: misses
+
+        The number of calls to :py:meth:`acquire` which created a new buffer.
+
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or 64 * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._idle = collections.OrderedDict()
+        self._idle_by_key = collections.defaultdict(list)
+        self._size = 0
+        self._sequence = 0
+
+    @property
+    def size(self):
+        """The total number of bytes held by idle buffers."""
+        return self._size
+
+    def acquire(self, key, factory):
+        """Return an idle buffer for *key*, calling *factory* with no arguments to create one if there is none.
+
+        :param key: a hashable key identifying the kind and size of buffer, for example ``('surface', width, height)``
+        :param factory: a callable returning a new buffer for *key*
+
+        """
+        with self._lock:
+            sequences = self._idle_by_key.get(key)
+            if sequences:
+                # reuse the most recently released buffer since its memory is most likely to be resident
+                buf, nbytes = self._idle.pop((key, sequences.pop()))
+                if not sequences:
+                    del self._idle_by_key[key]
+                self._size -= nbytes
+                self.hits += 1
+                return buf
+            self.misses += 1
+        return factory()
+
+    def release(self, key, buf, nbytes):
+        """Return *buf*, which was acquired for *key* and holds *nbytes* bytes, to the pool."""
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            while self._size + nbytes > self.max_bytes:
+                (evicted_key, evicted_sequence), (_, evicted_nbytes) = self._idle.popitem(last=False)
+                sequences = self._idle_by_key[evicted_key]
+                sequences.remove(evicted_sequence)
+                if not sequences:
+                    del self._idle_by_key[evicted_key]
+                self._size -= evicted_nbytes
+            self._sequence += 1
+            self._idle[(key, self._sequence)] = (buf, nbytes)
+            self._idle_by_key[key].append(self._sequence)
+            self._size += nbytes
+
+    def acquire_image_surface(self, width, height):
+        """Return a Cairo ARGB32 image surface of the given size cleared to transparent black."""
+        surface = self.acquire(('surface', width, height),
+                lambda: cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height))
+        cr = cairo.Context(surface)
+        cr.set_operator(cairo.OPERATOR_CLEAR)
+        cr.paint()
+        surface.flush()
+        return surface
+
+    def release_image_surface(self, surface):
+        """Return a surface obtained from :py:meth:`acquire_image_surface` to the pool."""
+        self.release(('surface', surface.get_width(), surface.get_height()), surface,
+                surface.get_stride() * surface.get_height())
+
+    def acquire_mem_dataset(self, width, height, band_count, data_type):
+        """Return a GDAL MEM dataset of the given size, number of bands and data type with every band filled with zero.
+        The caller should set the dataset's geo transform.
+
+        """
+        def create():
+            driver = gdal.GetDriverByName('MEM')
+            assert driver is not None
+            dataset = driver.Create('', width, height, band_count, data_type)
+            assert dataset is not None
+            return dataset
+
+        dataset = self.acquire(('mem', width, height, band_count, data_type), create)
+        for band_idx in xrange(band_count):
+            dataset.GetRasterBand(band_idx+1).Fill(0)
+        return dataset
+
+    def release_mem_dataset(self, dataset):
+        """Return a dataset obtained from :py:meth:`acquire_mem_dataset` to the pool."""
+        band_count = dataset.RasterCount
+        data_type = dataset.GetRasterBand(1).DataType
+        nbytes = dataset.RasterXSize * dataset.RasterYSize * band_count * (gdal.GetDataTypeSize(data_type) // 8)
+        self.release(('mem', dataset.RasterXSize, dataset.RasterYSize, band_count, data_type), dataset, nbytes)
+
+    def clear(self):
+        """Discard all idle buffers and reset the hit and miss counters."""
+        with self._lock:
+            self._idle.clear()
+            self._idle_by_key.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return a dictionary giving the *hits*, *misses*, number of idle *entries* and *size* in bytes of this pool."""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._idle), size=self._size)
+
+_default_buffer_pool = None
+_default_buffer_pool_lock = threading.Lock()
+
+def default_buffer_pool():
+    """Return the process-wide :py:class:`BufferPool` shared by renderers which have not been given one explicitly."""
+    global _default_buffer_pool
+    with _default_buffer_pool_lock:
+        if _default_buffer_pool is None:
+            _default_buffer_pool = BufferPool()
+        return _default_buffer_pool
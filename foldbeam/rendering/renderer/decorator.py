@@ -1,22 +1,131 @@
 """Method decorators suitable for renderers.
 
 """
+import collections
 from functools import wraps
 import logging
 import math
+import threading
+import time
 
 import cairo
 import numpy as np
-from osgeo import gdal, gdal_array
-from osgeo.ogr import CreateGeometryFromWkt
+from osgeo import gdal, gdal_array, ogr, osr
 
+from foldbeam.rendering.core import partial_reprojection
+from foldbeam.rendering.srs import spatial_reference_registry
 from foldbeam.rendering.renderer.base import set_geo_transform
+from foldbeam.rendering.renderer.buffer_pool import default_buffer_pool
+from foldbeam.rendering.renderer.warp import default_warp_engine, read_into_image_surface
 
 log = logging.getLogger()
 
 class ProjectionError(Exception):
     pass
 
+class _SpatialReferencePair(object):
+    """The per-pair state needed to reproject from a target spatial reference to a native one. The coordinate
+    transformation is created lazily for each thread which uses it.
+
+    """
+    def __init__(self, spatial_reference, native_spatial_reference, is_same):
+        self.is_same = is_same
+        self.spatial_reference = spatial_reference.Clone()
+        self.native_spatial_reference = native_spatial_reference.Clone()
+        self.wkt = self.spatial_reference.ExportToWkt()
+        self.native_wkt = self.native_spatial_reference.ExportToWkt()
+        self._local = threading.local()
+
+    @property
+    def transformation(self):
+        """An :py:class:`osgeo.osr.CoordinateTransformation` from the target to the native spatial reference."""
+        transformation = getattr(self._local, 'transformation', None)
+        if transformation is None:
+            transformation = osr.CoordinateTransformation(self.spatial_reference, self.native_spatial_reference)
+            self._local.transformation = transformation
+        return transformation
+
+class SpatialReferencePairCache(object):
+    """A thread-safe least-recently-used cache of the state needed to reproject between pairs of spatial references.
+
+    Successive renders between the same spatial references re-use the result of comparing them, their WKT and the
+    coordinate transformation between them. The cache records how much time was spent preparing this state for cache
+    hits and misses so that the saving can be measured.
+
+    Pairs are keyed by the keys given to each spatial reference by
+    :py:func:`foldbeam.rendering.srs.spatial_reference_registry` and so spatial references which are the same share an
+    entry whichever way they were constructed.
+
+    :param max_entries: default 64, the maximum number of spatial reference pairs to remember
+    :type max_entries: integer
+
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or 64
+        self._lock = threading.Lock()
+        self._pairs = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._hit_seconds = 0.0
+        self._miss_seconds = 0.0
+
+    def get(self, spatial_reference, native_spatial_reference):
+        """Return the state for reprojecting from *spatial_reference* to *native_spatial_reference*."""
+        start = time.time()
+        registry = spatial_reference_registry()
+        key = (registry.key(spatial_reference), registry.key(native_spatial_reference))
+        with self._lock:
+            pair = self._pairs.pop(key, None)
+            if pair is not None:
+                self._pairs[key] = pair
+                self._hits += 1
+                self._hit_seconds += time.time() - start
+                return pair
+
+        pair = _SpatialReferencePair(spatial_reference, native_spatial_reference, key[0] == key[1])
+        # create the transformation for this thread now so that its cost is accounted as part of the miss
+        if not pair.is_same:
+            pair.transformation
+
+        with self._lock:
+            self._pairs[key] = pair
+            while len(self._pairs) > self.max_entries:
+                self._pairs.popitem(last=False)
+            self._misses += 1
+            self._miss_seconds += time.time() - start
+        return pair
+
+    def stats(self):
+        """Return a dictionary giving the number of *hits* and *misses*, the mean time in seconds to prepare a pair
+        on a hit (*mean_hit_seconds*) and on a miss (*mean_miss_seconds*) and an estimate of the total time saved by
+        the cache (*saved_seconds*).
+
+        """
+        with self._lock:
+            mean_hit = self._hit_seconds / self._hits if self._hits > 0 else 0.0
+            mean_miss = self._miss_seconds / self._misses if self._misses > 0 else 0.0
+            return dict(
+                hits=self._hits, misses=self._misses,
+                mean_hit_seconds=mean_hit, mean_miss_seconds=mean_miss,
+                saved_seconds=self._hits * max(0.0, mean_miss - mean_hit),
+            )
+
+    def clear(self):
+        """Forget all cached pairs and reset the statistics."""
+        with self._lock:
+            self._pairs.clear()
+            self._hits = self._misses = 0
+            self._hit_seconds = self._miss_seconds = 0.0
+
+_spatial_reference_pair_cache = SpatialReferencePairCache()
+
+def spatial_reference_pair_cache():
+    """Return the process-wide :py:class:`SpatialReferencePairCache` used by
+    :py:func:`reproject_from_native_spatial_reference`.
+
+    """
+    return _spatial_reference_pair_cache
+
 def reproject_from_native_spatial_reference(f):
     """Wrap a rendering method by reprojecting rasterised images from a renderer which can handle only one spatial
     reference.
@@ -24,6 +133,19 @@ def reproject_from_native_spatial_reference(f):
     The object with the wrapped rendering method *must* have an attribute called :py:attr:`native_spatial_reference`
     which is an instance of :py:class:`osgeo.osr.SpatialReference` giving the native spatial reference for that renderer.
 
+    The object may optionally have an attribute called :py:attr:`warp_engine` giving the engine from
+    :py:mod:`foldbeam.rendering.renderer.warp` used to reproject the rasterised image. If it is absent or `None`, the
+    engine returned by :py:func:`foldbeam.rendering.renderer.warp.default_warp_engine` is used.
+
+    The object may also have an attribute called :py:attr:`max_intermediate_bytes` limiting the size of the intermediate
+    surface the native rendering is drawn into. Clip areas whose intermediate would be larger are split into blocks,
+    each rendered and reprojected in turn, so that memory use is bounded whatever the output size. If it is absent or
+    `None`, a limit of 64MiB is used.
+
+    Intermediate surfaces and GDAL datasets are reused between renders via the
+    :py:class:`foldbeam.rendering.renderer.buffer_pool.BufferPool` given by the object's optional :py:attr:`buffer_pool`
+    attribute or, if it is absent or `None`, the process-wide pool.
+
     """
     @wraps(f)
     def render_callable(self, context, spatial_reference=None, f=f, **kwargs):
@@ -32,119 +154,252 @@ def reproject_from_native_spatial_reference(f):
         assert(native_spatial_reference is not None)
 
         # If no spatial reference was specified, or if it matches the native one, just render directly
-        if spatial_reference is None or spatial_reference.IsSame(native_spatial_reference):
+        if spatial_reference is None:
+            return f(self, context, native_spatial_reference, **kwargs)
+        pair = _spatial_reference_pair_cache.get(spatial_reference, native_spatial_reference)
+        if pair.is_same:
             return f(self, context, native_spatial_reference, **kwargs)
 
-        log.info('Reprojecting from native SRS:')
-        log.info(native_spatial_reference.ExportToWkt())
-        log.info('to:')
-        log.info(spatial_reference.ExportToWkt())
+        if log.isEnabledFor(logging.INFO):
+            log.info('Reprojecting from native SRS:')
+            log.info(pair.native_wkt)
+            log.info('to:')
+            log.info(pair.wkt)
 
-        # Construct a polygon representing the current clip area's extent
         target_min_x, target_min_y, target_max_x, target_max_y = context.clip_extents()
 
-        wkt = 'POLYGON ((%s))' % (
-                ','.join(['%f %f' % x for x in [
-                    (target_min_x,target_min_y),
-                    (target_max_x,target_min_y),
-                    (target_max_x,target_max_y),
-                    (target_min_x,target_max_y),
-                    (target_min_x,target_min_y)
-                ]]),
-        )
-        geom = CreateGeometryFromWkt(wkt)
-        geom.AssignSpatialReference(spatial_reference)
+        # If, over the clip area, the native spatial reference is an affine transform of the target one then the
+        # native rendering can be painted directly through a Cairo matrix without an intermediate.
+        matrix = _affine_native_to_target_matrix(
+                pair, (target_min_x, target_min_y, target_max_x, target_max_y),
+                min(*[abs(x) for x in context.device_to_user_distance(1,1)]))
+        if matrix is not None:
+            log.info('Native SRS is affine over the clip area; painting without reprojection.')
+            return _render_through_matrix(self, context, native_spatial_reference, matrix, f, **kwargs)
 
-        # segmentise the geometry to the scale of one device pixel
+        # Reproject the clip area in blocks small enough that each intermediate fits within the memory limit
         seg_len = min(*[abs(x) for x in context.device_to_user_distance(1,1)])
-        geom.Segmentize(seg_len)
+        output_pixel_size = tuple(abs(x) for x in context.device_to_user_distance(1,1))
+        warp_engine = getattr(self, 'warp_engine', None) or default_warp_engine()
+        max_intermediate_bytes = getattr(self, 'max_intermediate_bytes', None) or _MAX_INTERMEDIATE_BYTES
+        buffer_pool = getattr(self, 'buffer_pool', None) or default_buffer_pool()
+
+        blocks = []
+        for extents in _split_extents(
+                (target_min_x, target_min_y, target_max_x, target_max_y),
+                seg_len, output_pixel_size, max_intermediate_bytes):
+            output_surface = _reproject_block(
+                    self, f, kwargs, pair, extents, seg_len, output_pixel_size, warp_engine, buffer_pool)
+            blocks.append((extents, output_surface))
 
-        # compute a rough resolution for the intermediate based on the segment length and clip extents
-        intermediate_size = (
-            int(math.ceil(abs(target_max_x - target_min_x) / seg_len)),
-            int(math.ceil(abs(target_max_y - target_min_y) / seg_len)),
-        )
+        def f():
+            for (min_x, min_y, max_x, max_y), output_surface in blocks:
+                # draw the transformed output to the context
+                context.set_source_surface(output_surface)
+                context.get_source().set_matrix(cairo.Matrix(
+                    xx = 1.0 / output_pixel_size[0],
+                    yy = -1.0 / output_pixel_size[1],
+                    x0 = -min_x / output_pixel_size[0],
+                    y0 = -max_y / -output_pixel_size[1],
+                ))
+
+                # draw the tile itself. We disable antialiasing because if the tile slightly overlaps an output
+                # pixel we want the interpolation of the tile to do the smoothing, not the rasteriser
+                context.save()
+                context.set_antialias(cairo.ANTIALIAS_NONE)
+                context.rectangle(min_x, min_y, max_x - min_x, max_y - min_y)
+                context.fill()
+                context.restore()
 
-        # transform the geometry to the native spatial reference
-        old_opt = gdal.GetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION')
-        gdal.SetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION', 'TRUE')
-        err = geom.TransformTo(native_spatial_reference)
-        gdal.SetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION', old_opt)
-        if err != 0:
-            raise ProjectionError('Unable to project boundary into target projection: ' + str(err))
+        return f
 
-        # get the envelope of the clip area in the native spatial reference
-        native_min_x, native_max_x, native_min_y, native_max_y = geom.GetEnvelope()
+    return render_callable
+
+# The default maximum number of bytes of pixel data in a single intermediate surface. Larger clip areas are
+# reprojected in blocks.
+_MAX_INTERMEDIATE_BYTES = 64 * 1024 * 1024
 
-        # create a cairo image surface for the intermediate
-        intermediate_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, intermediate_size[0], intermediate_size[1])
+def _split_extents(extents, seg_len, output_pixel_size, max_intermediate_bytes):
+    """Split the target *extents* (min_x, min_y, max_x, max_y) into a list of blocks, aligned to output pixels, whose
+    intermediate surfaces each need at most roughly *max_intermediate_bytes* bytes.
+
+    """
+    min_x, min_y, max_x, max_y = extents
+    width, height = abs(max_x - min_x), abs(max_y - min_y)
+    intermediate_bytes = 4 * math.ceil(width / seg_len) * math.ceil(height / seg_len)
+    n_blocks = int(math.ceil(intermediate_bytes / float(max_intermediate_bytes)))
+    if n_blocks <= 1:
+        return [extents]
+
+    # choose a grid of blocks which are roughly square
+    n_x = max(1, int(math.ceil(math.sqrt(n_blocks * width / max(height, seg_len)))))
+    n_y = max(1, int(math.ceil(n_blocks / float(n_x))))
+
+    # block edges fall on output pixel boundaries so that there are no seams between blocks
+    output_width = int(math.ceil(width / output_pixel_size[0]))
+    output_height = int(math.ceil(height / output_pixel_size[1]))
+    block_width = int(math.ceil(output_width / float(n_x))) or 1
+    block_height = int(math.ceil(output_height / float(n_y))) or 1
+
+    blocks = []
+    for y in xrange(0, output_height, block_height):
+        block_min_y = min_y + y * output_pixel_size[1]
+        block_max_y = min(max_y, min_y + (y + block_height) * output_pixel_size[1])
+        for x in xrange(0, output_width, block_width):
+            block_min_x = min_x + x * output_pixel_size[0]
+            block_max_x = min(max_x, min_x + (x + block_width) * output_pixel_size[0])
+            blocks.append((block_min_x, block_min_y, block_max_x, block_max_y))
+    return blocks
+
+def _reproject_block(self, f, kwargs, pair, extents, seg_len, output_pixel_size, warp_engine, buffer_pool):
+    """Render the native rendering method *f* into an intermediate covering the target *extents* and reproject it.
+    Return a Cairo image surface with one pixel per output pixel whose top-left corner is at (min_x, max_y). The
+    intermediate surface and dataset and the output dataset are taken from and returned to *buffer_pool*.
+
+    """
+    target_min_x, target_min_y, target_max_x, target_max_y = extents
+
+    # Construct a polygon representing the block's extent
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in (
+            (target_min_x,target_min_y),
+            (target_max_x,target_min_y),
+            (target_max_x,target_max_y),
+            (target_min_x,target_max_y),
+            (target_min_x,target_min_y)):
+        ring.AddPoint_2D(x, y)
+    geom = ogr.Geometry(ogr.wkbPolygon)
+    geom.AddGeometry(ring)
+
+    # segmentise the geometry to the scale of one device pixel
+    geom.Segmentize(seg_len)
+
+    # compute a rough resolution for the intermediate based on the segment length and clip extents
+    intermediate_size = (
+        int(math.ceil(abs(target_max_x - target_min_x) / seg_len)),
+        int(math.ceil(abs(target_max_y - target_min_y) / seg_len)),
+    )
+
+    # transform the geometry to the native spatial reference
+    with partial_reprojection():
+        err = geom.Transform(pair.transformation)
+    if err != 0:
+        raise ProjectionError('Unable to project boundary into target projection: ' + str(err))
+
+    # get the envelope of the clip area in the native spatial reference
+    native_min_x, native_max_x, native_min_y, native_max_y = geom.GetEnvelope()
+
+    # get a cairo image surface for the intermediate along with a dataset sharing its pixels
+    intermediate_key = ('intermediate',) + intermediate_size
+    intermediate_surface, intermediate_dataset = buffer_pool.acquire(
+            intermediate_key, lambda: _create_intermediate(*intermediate_size))
+    output_dataset = None
+    try:
         intermediate_context = cairo.Context(intermediate_surface)
+        intermediate_context.set_operator(cairo.OPERATOR_CLEAR)
+        intermediate_context.paint()
+        intermediate_context.set_operator(cairo.OPERATOR_OVER)
         set_geo_transform(
                 intermediate_context,
                 native_min_x, native_max_x, native_max_y, native_min_y,
                 intermediate_size[0], intermediate_size[1]
         )
 
-        # render the intermediate
-        f(self, intermediate_context, native_spatial_reference, **kwargs)()
+        # render the intermediate. The dataset may have been used for a previous render and so any blocks GDAL has
+        # cached from it must be discarded now that Cairo has drawn into its memory.
+        f(self, intermediate_context, pair.native_spatial_reference, **kwargs)()
+        intermediate_surface.flush()
+        intermediate_dataset.FlushCache()
 
-        # get hold of the intermediate surface as a dataset
-        intermediate_dataset = _image_surface_to_dataset(intermediate_surface)
-        assert intermediate_dataset is not None
         intermediate_dataset.SetGeoTransform((
             native_min_x, (native_max_x-native_min_x) / float(intermediate_size[0]), 0.0, 
             native_max_y, 0.0, -(native_max_y-native_min_y) / float(intermediate_size[1]),
         ))
 
-        # create an output dataset
-        output_pixel_size = context.device_to_user_distance(1,1)
-        output_width = int(math.ceil(abs(target_max_x - target_min_x) / abs(output_pixel_size[0])))
-        output_height = int(math.ceil(abs(target_max_y - target_min_y) / abs(output_pixel_size[1])))
-        driver = gdal.GetDriverByName('MEM')
-        assert driver is not None
-        output_dataset = driver.Create('', output_width, output_height, 4, gdal.GDT_Byte)
-        assert output_dataset is not None
+        # get an output dataset
+        output_width = int(math.ceil(abs(target_max_x - target_min_x) / output_pixel_size[0]))
+        output_height = int(math.ceil(abs(target_max_y - target_min_y) / output_pixel_size[1]))
+        output_dataset = buffer_pool.acquire_mem_dataset(output_width, output_height, 4, gdal.GDT_Byte)
         output_dataset.SetGeoTransform((
-            target_min_x, abs(output_pixel_size[0]), 0.0,
-            target_max_y, 0.0, -abs(output_pixel_size[1]),
+            target_min_x, output_pixel_size[0], 0.0,
+            target_max_y, 0.0, -output_pixel_size[1],
         ))
 
         # project intermediate into output
-        gdal.ReprojectImage(
-                intermediate_dataset, output_dataset,
-                native_spatial_reference.ExportToWkt(), spatial_reference.ExportToWkt(),
-                gdal.GRA_Bilinear
-        )
+        warp_engine.warp(intermediate_dataset, output_dataset, pair, gdal.GRA_Bilinear)
 
-        # create a cairo image surface for the output. This unfortunately necessitates a copy since the in-memory format
-        # for a GDAL Dataset is not interleaved.
-        output_array = np.transpose(output_dataset.ReadAsArray(), (1,2,0))
+        # read the output into a cairo image surface. The bands are already in Cairo's order since the intermediate was
+        # a Cairo surface. The surface is retained until painted and so is not pooled.
         output_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, output_width, output_height)
-        surface_array = np.frombuffer(output_surface.get_data(), dtype=np.uint8)
-        surface_array[:] = output_array.flat
-        output_surface.mark_dirty()
+        read_into_image_surface(output_dataset, output_surface)
+    finally:
+        buffer_pool.release(intermediate_key, (intermediate_surface, intermediate_dataset),
+                intermediate_surface.get_stride() * intermediate_surface.get_height())
+        if output_dataset is not None:
+            buffer_pool.release_mem_dataset(output_dataset)
+
+    return output_surface
+
+def _create_intermediate(width, height):
+    """Return a new Cairo image surface of the given size and a GDAL dataset pointing to its pixels."""
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    dataset = _image_surface_to_dataset(surface)
+    assert dataset is not None
+    return surface, dataset
+
+# The number of control points along each axis of the clip area used to test for an affine relationship and the
+# maximum error, in output pixels, for which the relationship is accepted.
+_AFFINE_CONTROL_POINTS = 4
+_AFFINE_TOLERANCE = 0.1
+
+def _affine_native_to_target_matrix(pair, target_extents, pixel_size):
+    """Return a :py:class:`cairo.Matrix` mapping native co-ordinates to target co-ordinates if the two are related by
+    an affine transform to within :py:data:`_AFFINE_TOLERANCE` output pixels over *target_extents*. Otherwise return
+    `None`.
 
-        def f():
-            # draw the transformed output to the context
-            context.set_source_surface(output_surface)
-            context.get_source().set_matrix(cairo.Matrix(
-                xx = 1.0 / abs(output_pixel_size[0]),
-                yy = -1.0 / abs(output_pixel_size[1]),
-                x0 = -target_min_x / abs(output_pixel_size[0]),
-                y0 = -target_max_y / -abs(output_pixel_size[1]),
-            ))
-
-            # draw the tile itself. We disable antialiasing because if the tile slightly overlaps an output
-            # pixel we want the interpolation of the tile to do the smoothing, not the rasteriser
-            context.save()
-            context.set_antialias(cairo.ANTIALIAS_NONE)
-            context.rectangle(target_min_x, target_min_y, target_max_x - target_min_x, target_max_y - target_min_y)
-            context.fill()
-            context.restore()
+    """
+    target_min_x, target_min_y, target_max_x, target_max_y = target_extents
+    xs, ys = np.meshgrid(
+            np.linspace(target_min_x, target_max_x, _AFFINE_CONTROL_POINTS),
+            np.linspace(target_min_y, target_max_y, _AFFINE_CONTROL_POINTS))
+    target = np.column_stack((xs.flat, ys.flat))
+
+    native = np.array(pair.transformation.TransformPoints(target.tolist()), dtype=np.float64)[:,:2]
+    if not np.all(np.isfinite(native)) or np.any(np.abs(native) > 1e30):
+        return None
+
+    # least-squares fit of target = [native_x, native_y, 1] . coefficients
+    design = np.column_stack((native, np.ones(native.shape[0])))
+    coefficients = np.linalg.lstsq(design, target, rcond=-1)[0]
+    if np.max(np.abs(np.dot(design, coefficients) - target)) > _AFFINE_TOLERANCE * pixel_size:
+        return None
+
+    (xx, yx), (xy, yy), (x0, y0) = coefficients
+    if abs(xx * yy - xy * yx) < 1e-12 * max(1.0, abs(xx * yy), abs(xy * yx)):
+        return None
+    return cairo.Matrix(xx=xx, yx=yx, xy=xy, yy=yy, x0=x0, y0=y0)
+
+def _render_through_matrix(self, context, native_spatial_reference, matrix, f, **kwargs):
+    """Call the rendering method *f* in native co-ordinates by transforming *context* with *matrix* both when
+    preparing and when painting.
 
-        return f
+    """
+    context.save()
+    try:
+        context.transform(matrix)
+        paint = f(self, context, native_spatial_reference, **kwargs)
+    finally:
+        context.restore()
+
+    def paint_through_matrix():
+        context.save()
+        try:
+            context.transform(matrix)
+            paint()
+        finally:
+            context.restore()
 
-    return render_callable
+    return paint_through_matrix
 
 def _image_surface_to_array(image_surface):
     """Return a numpy array pointing to a Cairo image surface
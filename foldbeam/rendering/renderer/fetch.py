@@ -0,0 +1,365 @@
+"""Support for fetching many URLs concurrently on behalf of a renderer.
+
+"""
+import httplib
+import itertools
+import logging
+import Queue
+import socket
+import sys
+import threading
+import urlparse
+
+import httplib2
+
+log = logging.getLogger()
+
+class URLFetchError(Exception):
+    """An error raised by a custom URL fetchber for TileFetcher if the URL could not be fetchbed.
+
+    :param message: a description of the error
+    :type message: str
+    :param status: default None, the HTTP status code of the response if there was one
+    :type status: integer or None
+    :param transient: default False, True if the fetch failed for a reason which may not recur, such as a timeout or
+        a dropped connection, rather than because the resource does not exist
+    :type transient: bool
+    :param cause: default None, the exception which caused this error if there was one
+
+    """
+    def __init__(self, message, status=None, transient=False, cause=None):
+        super(URLFetchError, self).__init__(message)
+        self.status = status
+        self.transient = transient
+        self.cause = cause
+
+class FetchTimeoutError(URLFetchError):
+    """An error raised when waiting for a fetch to complete has timed out. The fetch itself may yet complete."""
+    def __init__(self, message):
+        super(FetchTimeoutError, self).__init__(message, transient=True)
+
+class FetchCancelledError(URLFetchError):
+    """An error raised when the result of a fetch which was cancelled before it started is requested."""
+    pass
+
+class FetchFuture(object):
+    """The pending result of a URL fetch submitted to a :py:class:`FetchPool`.
+
+    .. py:attribute:: url
+
+        The URL being fetched.
+
+    """
+    def __init__(self, url):
+        self.url = url
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._started = False
+        self._sharers = 1
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        """Return True if the fetch has completed, successfully or otherwise, or was cancelled."""
+        return self._done.is_set()
+
+    def cancel(self):
+        """Attempt to cancel the fetch. A fetch can only be cancelled if it has not yet started. A fetch shared by
+        several submissions to a :py:class:`FetchPool` with the same key is only cancelled once each of them has
+        cancelled it.
+
+        :returns: True if the fetch was cancelled, in which case :py:meth:`result` raises FetchCancelledError
+
+        """
+        with self._lock:
+            if self._started:
+                return False
+            self._sharers -= 1
+            if self._sharers > 0:
+                return False
+            self._started = True
+        try:
+            raise FetchCancelledError('Fetch of %s was cancelled' % (self.url,))
+        except FetchCancelledError:
+            self._set_exc_info(sys.exc_info())
+        return True
+
+    def result(self, timeout=None):
+        """Block until the fetch has completed and return the fetched data. If the fetch raised an exception, it is
+        re-raised in the caller's thread.
+
+        :param timeout: default None, the maximum time in seconds to wait or None to wait indefinitely
+        :type timeout: float or None
+        :raises FetchTimeoutError: if *timeout* is not None and the fetch did not complete in time
+
+        """
+        if not self._done.wait(timeout):
+            raise FetchTimeoutError('Timed out waiting for %s' % (self.url,))
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def _share(self):
+        """Register another user of this fetch. Return False if the fetch has already completed or been cancelled."""
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._sharers += 1
+            return True
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return False
+            self._started = True
+            return True
+
+    def _set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def _set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+class FetchPool(object):
+    """A bounded pool of worker threads which fetch URLs concurrently.
+
+    At most *max_workers* fetches are in flight at any one time and, of those, at most *max_per_host* are to any one
+    host. Worker threads are started lazily as fetches are submitted and are daemon threads so that a pool never keeps
+    the process alive.
+
+    Queued fetches are started in order of increasing priority and, for equal priorities, in the order they were
+    submitted. A queued fetch may be cancelled via :py:meth:`FetchFuture.cancel`.
+
+    Fetches submitted with a *key* are coalesced: while a fetch with that key is queued or running, submitting another
+    returns the same :py:class:`FetchFuture` rather than queueing a duplicate. Duplicate requests therefore wait for
+    the original without occupying a worker or a connection to the host.
+
+    :param max_workers: default 8, the maximum number of concurrent fetches
+    :type max_workers: integer
+    :param max_per_host: default 4, the maximum number of concurrent fetches to a single host
+    :type max_per_host: integer
+
+    .. py:attribute:: coalesced
+
+        The number of calls to :py:meth:`submit` which shared a fetch already queued or running.
+
+    """
+    def __init__(self, max_workers=None, max_per_host=None):
+        self.max_workers = max_workers or 8
+        self.max_per_host = max_per_host or 4
+        self.coalesced = 0
+
+        self._queue = Queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+        self._workers = []
+        self._in_flight = {}
+
+    def submit(self, fetcher, url, priority=0, key=None):
+        """Schedule *url* to be fetched by calling *fetcher* with it as the only argument.
+
+        :param fetcher: a thread-safe URL fetcher callable
+        :param url: the URL to fetch
+        :type url: string
+        :param priority: default 0, fetches with lower priority values are started first
+        :type priority: number
+        :param key: default None, if not None a hashable key identifying the result of the fetch used to coalesce it
+            with any other queued or running fetch with the same key
+        :rtype: :py:class:`FetchFuture`
+
+        """
+        if key is not None:
+            with self._lock:
+                future = self._in_flight.get(key)
+                if future is not None and future._share():
+                    self.coalesced += 1
+                    return future
+                future = FetchFuture(url)
+                self._in_flight[key] = future
+        else:
+            future = FetchFuture(url)
+
+        self._queue.put((priority, next(self._sequence), fetcher, future, key))
+        self._ensure_workers()
+        return future
+
+    def _ensure_workers(self):
+        with self._lock:
+            if len(self._workers) >= self.max_workers:
+                return
+            worker = threading.Thread(target=self._work, name='FetchPool-%s' % (len(self._workers),))
+            worker.daemon = True
+            self._workers.append(worker)
+        worker.start()
+
+    def _host_semaphore(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_per_host)
+                self._host_semaphores[host] = semaphore
+            return semaphore
+
+    def _forget(self, key, future):
+        if key is None:
+            return
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _work(self):
+        while True:
+            _, _, fetcher, future, key = self._queue.get()
+            if not future._start():
+                # the fetch was cancelled while queued
+                self._forget(key, future)
+                self._queue.task_done()
+                continue
+            try:
+                semaphore = self._host_semaphore(future.url)
+                with semaphore:
+                    future._set_result(fetcher(future.url))
+            except Exception:
+                future._set_exc_info(sys.exc_info())
+            finally:
+                self._forget(key, future)
+                self._queue.task_done()
+
+class SingleFlight(object):
+    """Coalesce concurrent calls which would compute the same result.
+
+    A caller waiting for a call in flight blocks its thread and so work submitted to a :py:class:`FetchPool` should
+    instead be coalesced by passing a *key* to :py:meth:`FetchPool.submit`.
+
+    The first caller of :py:meth:`do` for a given key runs the callable. Any other caller using the same key while that
+    call is in flight waits for it to finish and receives the same result or has the same exception raised. Once the
+    call has finished, the key is forgotten and the next caller will run the callable again.
+
+    .. py:attribute:: calls
+
+        The number of calls to :py:meth:`do` which ran their callable.
+
+    .. py:attribute:: shared
+
+        The number of calls to :py:meth:`do` which instead waited for a call already in flight.
+
+    """
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def do(self, key, f, *args, **kwargs):
+        """Call *f* with the remaining arguments unless a call for *key* is already in flight in which case wait for
+        and return its result.
+
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+                leader = False
+            else:
+                future = FetchFuture(key)
+                self._in_flight[key] = future
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            return future.result()
+
+        try:
+            future._set_result(f(*args, **kwargs))
+        except Exception:
+            future._set_exc_info(sys.exc_info())
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+        return future.result()
+
+class HTTPFetcher(object):
+    """A thread-safe URL fetcher which keeps connections to each host alive between requests.
+
+    An instance of this class is a callable suitable for passing as the *url_fetcher* parameter of
+    :py:class:`foldbeam.rendering.renderer.TileFetcher`. It maintains, for each host, a pool of
+    :py:class:`httplib2.Http` objects. Each of these holds a keep-alive connection and so successive requests to the
+    same host avoid the TCP and TLS setup cost. At most *pool_size* requests to any one host are made concurrently;
+    further requests block until a connection is free.
+
+    If there is an error fetching the URL a :py:class:`URLFetchError` is raised. Errors in the transport, such as the
+    request timing out, raise a :py:class:`URLFetchError` with :py:attr:`transient` set whose :py:attr:`cause` is the
+    original exception.
+
+    :param pool_size: default 4, the maximum number of connections to keep open to any one host
+    :type pool_size: integer
+    :param cache: default None, a directory name or cache object passed to :py:class:`httplib2.Http`
+    :param timeout: default None, the socket timeout in seconds for each request
+    :type timeout: float or None
+
+    """
+    def __init__(self, pool_size=None, cache=None, timeout=None):
+        self.pool_size = pool_size or 4
+        self.cache = cache
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def __call__(self, url):
+        semaphore, idle = self._host_pool(url)
+        with semaphore:
+            try:
+                http = idle.pop()
+            except IndexError:
+                http = httplib2.Http(self.cache, timeout=self.timeout)
+
+            # a connection which raised is in an unknown state and so is not returned to the pool
+            try:
+                rep, content = http.request(url, 'GET')
+            except _TRANSPORT_ERRORS as e:
+                raise _transient_fetch_error(url, e), None, sys.exc_info()[2]
+            idle.append(http)
+
+        if rep.status != 200:
+            raise URLFetchError(str(rep.status) + ' ' + rep.reason, status=rep.status)
+        return content
+
+    def _host_pool(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self._lock:
+            pool = self._hosts.get(host)
+            if pool is None:
+                pool = (threading.BoundedSemaphore(self.pool_size), [])
+                self._hosts[host] = pool
+            return pool
+
+# the exceptions raised by a failure of the connection to a server rather than by the server's response
+_TRANSPORT_ERRORS = (socket.error, httplib.HTTPException, httplib2.HttpLib2Error)
+
+def _transient_fetch_error(url, error):
+    """Return a transient :py:class:`URLFetchError` for the transport *error* raised while fetching *url*."""
+    return URLFetchError('Error fetching %s: %s' % (url, error), transient=True, cause=error)
+
+_default_fetch_pool = None
+_default_fetch_pool_lock = threading.Lock()
+
+def default_fetch_pool():
+    """Return the process-wide :py:class:`FetchPool` used by renderers which have not been given one explicitly."""
+    global _default_fetch_pool
+    with _default_fetch_pool_lock:
+        if _default_fetch_pool is None:
+            _default_fetch_pool = FetchPool()
+        return _default_fetch_pool
+
+_default_single_flight = SingleFlight()
+
+def default_single_flight():
+    """Return a process-wide :py:class:`SingleFlight` which may be shared to coalesce calls across a process."""
+    return _default_single_flight
@@ -1,3 +1,4 @@
+import logging
 import math
 
 import cairo
@@ -7,6 +8,8 @@ from foldbeam.rendering.core import Envelope
 from foldbeam.rendering.core import boundary_from_envelope
 from foldbeam.rendering.renderer import RendererBase
 
+log = logging.getLogger()
+
 class Geometry(RendererBase):
     """Render shapely geometric shapes into a context.
 
@@ -78,11 +81,17 @@ class Geometry(RendererBase):
         geometry = self.geom.within(boundary, spatial_reference)
 
         def f():
-            for g in geometry:
+            geoms = list(geometry)
+
+            # cull points whose markers fall entirely outside of the clip region in one vectorised test
+            visible = iter(self._points_within(geoms, boundary))
+
+            for g in geoms:
                 if g.geom_type == 'Point':
-                    self._render_point(g, context)
+                    if next(visible):
+                        self._render_point(g, context)
                 elif g.geom_type == 'MultiPoint':
-                    [self._render_point(x, context) for x in g]
+                    [self._render_point(x, context) for x in g if next(visible)]
                 elif g.geom_type == 'LineString':
                     self._render_line_string(g, context)
                 elif g.geom_type == 'MultiLineString':
@@ -115,6 +124,24 @@ class Geometry(RendererBase):
                 self.prepare_stroke(context)
             context.stroke()
 
+    def _points_within(self, geoms, boundary):
+        """Return a boolean mask with one element for each point in *geoms*, taking the points of multi-points in
+        order, which is True where that point is within *boundary*.
+
+        """
+        xs, ys = [], []
+        for g in geoms:
+            if g.geom_type == 'Point':
+                xs.append(g.x)
+                ys.append(g.y)
+            elif g.geom_type == 'MultiPoint':
+                for p in g:
+                    xs.append(p.x)
+                    ys.append(p.y)
+        if len(xs) == 0:
+            return np.zeros((0,), dtype=np.bool_)
+        return boundary.contains_points(np.array(xs), np.array(ys))
+
     def _render_point(self, p, context):
         scale = max([abs(x) for x in context.device_to_user_distance(1,1)])
         context.arc(p.x, p.y, self.marker_radius * scale, 0, math.pi * 2.0)
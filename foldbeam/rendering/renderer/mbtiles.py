@@ -0,0 +1,60 @@
+"""Support for reading tiles from local MBTiles files.
+
+See https://github.com/mapbox/mbtiles-spec for a description of the format.
+"""
+import logging
+import os
+import sqlite3
+import threading
+
+log = logging.getLogger()
+
+class MBTilesSource(object):
+    """A tile source reading tiles from an MBTiles file, an SQLite database with tiles indexed by zoom, column and row.
+
+    An instance may be passed as the *tile_source* parameter of :py:class:`foldbeam.rendering.renderer.TileFetcher`
+    to render tiles without needing the network. The file is opened read-only with one connection per thread and so a
+    source may be shared between threads.
+
+    MBTiles files store rows in TMS order, with row 0 at the bottom. The tile co-ordinates used by this class are the
+    same as those of :py:class:`foldbeam.rendering.renderer.TileFetcher`, with row 0 at the top.
+
+    :param path: the path to the MBTiles file
+    :type path: string
+    :raises IOError: if *path* does not exist
+
+    .. py:attribute:: url_pattern
+
+        A pattern for pseudo-URLs identifying tiles within this file. It is used by
+        :py:class:`foldbeam.rendering.renderer.TileFetcher` as the key for tiles in its caches.
+
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if not os.path.isfile(self.path):
+            raise IOError('No such MBTiles file: %s' % (self.path,))
+        self.url_pattern = 'mbtiles://' + self.path + '/{zoom}/{x}/{y}'
+
+        self._local = threading.local()
+
+    @property
+    def metadata(self):
+        """A dictionary of the name/value pairs in the file's metadata table."""
+        return dict(self._db().execute('SELECT name, value FROM metadata'))
+
+    def get_tile(self, x, y, zoom):
+        """Return the data for tile (*x*, *y*) at *zoom* or `None` if the file has no such tile."""
+        row = self._db().execute(
+                'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                (zoom, x, (1<<zoom) - 1 - y)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path)
+            db.execute('PRAGMA query_only = 1')
+            self._local.db = db
+        return db
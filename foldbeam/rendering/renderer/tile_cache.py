@@ -0,0 +1,399 @@
+"""Caches for tiles which have already been fetched and decoded by a renderer.
+
+"""
+import collections
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+log = logging.getLogger()
+
+class SurfaceCache(object):
+    """A thread-safe least-recently-used cache of decoded Cairo image surfaces keyed by an arbitrary hashable key,
+    usually the URL the surface was decoded from.
+
+    The cache is bounded by the total number of bytes of pixel data held by the surfaces within it rather than by the
+    number of surfaces. When adding a surface would exceed the budget, the least recently used surfaces are discarded
+    until it fits. A surface larger than the entire budget is never cached.
+
+    Surfaces within the cache are shared between all users of the cache and so must be treated as read-only.
+
+    :param max_bytes: default 64MiB, the maximum number of bytes of pixel data to hold
+    :type max_bytes: integer
+
+    .. py:attribute:: hits
+
+        The number of calls to :py:meth:`get` which found a surface.
+
+    .. py:attribute:: misses
+
+        The number of calls to :py:meth:`get` which did not find a surface.
+
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or 64 * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._surfaces = collections.OrderedDict()
+        self._size = 0
+
+    @property
+    def size(self):
+        """The total number of bytes of pixel data currently cached."""
+        return self._size
+
+    def __len__(self):
+        return len(self._surfaces)
+
+    def get(self, key, count=True):
+        """Return the surface cached for *key* or `None` if there is none, marking it as most recently used.
+
+        :param count: default True, count this lookup in :py:attr:`hits` or :py:attr:`misses`. Pass False for a
+            lookup which repeats or supplements one which has already been counted.
+        :type count: bool
+
+        """
+        with self._lock:
+            surface = self._surfaces.pop(key, None)
+            if surface is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._surfaces[key] = surface
+            if count:
+                self.hits += 1
+            return surface
+
+    def put(self, key, surface):
+        """Add *surface* to the cache under *key*, evicting the least recently used surfaces if necessary."""
+        nbytes = _surface_size(surface)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._surfaces.pop(key, None)
+            if old is not None:
+                self._size -= _surface_size(old)
+            while self._size + nbytes > self.max_bytes:
+                _, evicted = self._surfaces.popitem(last=False)
+                self._size -= _surface_size(evicted)
+            self._surfaces[key] = surface
+            self._size += nbytes
+
+    def clear(self):
+        """Discard all cached surfaces and reset the hit and miss counters."""
+        with self._lock:
+            self._surfaces.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return a dictionary giving the *hits*, *misses*, number of *entries* and *size* in bytes of this cache."""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._surfaces), size=self._size)
+
+def _surface_size(surface):
+    return surface.get_stride() * surface.get_height()
+
+class DiskTileCache(object):
+    """A size-bounded, content-addressed cache of raw tile data on disk.
+
+    An instance may be passed as the *tile_cache* parameter of :py:class:`foldbeam.rendering.renderer.TileFetcher` to
+    persist fetched tiles between renders and between processes.
+
+    Each tile is stored in a file named after the SHA1 hash of its key, usually the tile's URL. Files are sharded into
+    two levels of sub-directory by the leading characters of the hash so that no single directory grows too large.
+    Files are written to a temporary file and atomically renamed into place so that a reader never sees a partially
+    written tile.
+
+    The size and usage of each tile is recorded in an SQLite index within the cache directory so that neither lookup
+    nor eviction ever needs to scan the directory. When adding a tile takes the total size of the cache over
+    *max_bytes*, tiles are evicted according to *policy* which is either ``'lru'`` to evict the least recently used
+    tiles first or ``'lfu'`` to evict the least frequently used tiles first.
+
+    SQLite's locking makes the cache safe to share between threads and between processes, including processes forked
+    after the cache was created. The index is kept in SQLite's write-ahead log mode so that readers never wait for a
+    writer. The cache directory must therefore not be on a network filesystem.
+
+    So that a cache hit does not need a write transaction, accesses to tiles are counted in memory and written to the
+    index in a single transaction at most every *flush_interval* seconds and before any tile is evicted. Accesses
+    which have not been written when a process exits are lost, which only slightly affects the choice of tiles to evict.
+
+    :param directory: the directory to store the cache in, created if it does not exist
+    :type directory: string
+    :param max_bytes: default 256MiB, the maximum total size of tile data to keep
+    :type max_bytes: integer
+    :param policy: default ``'lru'``, the eviction policy
+    :type policy: string
+    :param flush_interval: default 5, the maximum number of seconds between writes of tile accesses to the index
+    :type flush_interval: float
+
+    """
+    _ORDER_BY = { 'lru': 'last_access, hits', 'lfu': 'hits, last_access' }
+
+    def __init__(self, directory, max_bytes=None, policy=None, flush_interval=None):
+        self.directory = directory
+        self.max_bytes = max_bytes or 256 * 1024 * 1024
+        self.policy = policy or 'lru'
+        if self.policy not in DiskTileCache._ORDER_BY:
+            raise ValueError('Unknown eviction policy: %s' % (self.policy,))
+        self.flush_interval = flush_interval if flush_interval is not None else 5.0
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e: # pragma: no coverage
+                # another process may have beaten us to it
+                if e.errno != errno.EEXIST:
+                    raise
+
+        self._local = threading.local()
+
+        # accesses not yet written to the index as a mapping from digest to a [hits, last_access] pair
+        self._accesses_lock = threading.Lock()
+        self._accesses = {}
+        self._accesses_pid = os.getpid()
+        self._last_flush = time.time()
+
+        db = self._db()
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS tiles ('
+                    'key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL, hits INTEGER NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access)')
+            db.execute('CREATE INDEX IF NOT EXISTS tiles_hits ON tiles (hits)')
+            db.execute('CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)')
+            db.execute('INSERT OR IGNORE INTO totals (id, size) VALUES (0, 0)')
+
+    @property
+    def size(self):
+        """The total number of bytes of tile data currently cached."""
+        return self._db().execute('SELECT size FROM totals WHERE id = 0').fetchone()[0]
+
+    def __len__(self):
+        return self._db().execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+
+    def get(self, key):
+        """Return the data cached for *key* or `None` if there is none."""
+        digest = _digest(key)
+        try:
+            with open(self._path(digest), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        self._record_access(digest)
+        return data
+
+    def put(self, key, data):
+        """Store *data* in the cache under *key*, evicting other tiles if necessary."""
+        if len(data) > self.max_bytes:
+            return
+
+        digest = _digest(key)
+        path = self._path(digest)
+        shard_dir = os.path.dirname(path)
+        if not os.path.isdir(shard_dir):
+            try:
+                os.makedirs(shard_dir)
+            except OSError as e: # pragma: no coverage
+                if e.errno != errno.EEXIST:
+                    raise
+
+        fd, temp_path = tempfile.mkstemp(dir=shard_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+        db = self._db()
+        with db:
+            # take the write lock up front so that concurrent writers serialise their accounting
+            db.execute('BEGIN IMMEDIATE')
+            self._write_accesses(db, self._take_accesses())
+            row = db.execute('SELECT size FROM tiles WHERE key = ?', (digest,)).fetchone()
+            if row is None:
+                db.execute('INSERT INTO tiles (key, size, last_access, hits) VALUES (?, ?, ?, 0)',
+                        (digest, len(data), time.time()))
+                delta = len(data)
+            else:
+                db.execute('UPDATE tiles SET size = ?, last_access = ? WHERE key = ?', (len(data), time.time(), digest))
+                delta = len(data) - row[0]
+            db.execute('UPDATE totals SET size = size + ? WHERE id = 0', (delta,))
+            self._evict(db, digest)
+
+    def _record_access(self, digest):
+        now = time.time()
+        with self._accesses_lock:
+            self._reset_accesses_after_fork()
+            access = self._accesses.get(digest)
+            if access is None:
+                self._accesses[digest] = [1, now]
+            else:
+                access[0] += 1
+                access[1] = now
+            if now - self._last_flush < self.flush_interval:
+                return
+
+        accesses = self._take_accesses()
+        db = self._db()
+        with db:
+            self._write_accesses(db, accesses)
+
+    def _take_accesses(self):
+        """Return and forget the accesses which have not been written to the index."""
+        with self._accesses_lock:
+            self._reset_accesses_after_fork()
+            accesses, self._accesses = self._accesses, {}
+            self._last_flush = time.time()
+            return accesses
+
+    def _reset_accesses_after_fork(self):
+        # accesses recorded before a fork are written by the parent process
+        pid = os.getpid()
+        if self._accesses_pid != pid:
+            self._accesses, self._accesses_pid = {}, pid
+
+    def _write_accesses(self, db, accesses):
+        if len(accesses) == 0:
+            return
+        db.executemany('UPDATE tiles SET last_access = MAX(last_access, ?), hits = hits + ? WHERE key = ?',
+                [(last_access, hits, digest) for digest, (hits, last_access) in accesses.iteritems()])
+
+    def _evict(self, db, keep):
+        total = db.execute('SELECT size FROM totals WHERE id = 0').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = []
+        query = 'SELECT key, size FROM tiles WHERE key != ? ORDER BY ' + DiskTileCache._ORDER_BY[self.policy]
+        for digest, size in db.execute(query, (keep,)):
+            evicted.append((digest, size))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+        db.executemany('DELETE FROM tiles WHERE key = ?', [(digest,) for digest, _ in evicted])
+        db.execute('UPDATE totals SET size = ? WHERE id = 0', (total,))
+
+        for digest, _ in evicted:
+            try:
+                os.unlink(self._path(digest))
+            except OSError: # pragma: no coverage
+                pass
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def _db(self):
+        # connections may be shared neither between threads nor across a fork
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, pid
+        return self._local.db
+
+def _digest(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf8')
+    return hashlib.sha1(key).hexdigest()
+
+class NegativeCache(object):
+    """A thread-safe record of tiles which are known to be missing upstream.
+
+    A failed fetch is remembered for *ttl* seconds by :py:meth:`put`. Until then, :py:meth:`check` re-raises the
+    failure without contacting the upstream server. Only failures which indicate that a tile does not exist are
+    remembered: a :py:class:`foldbeam.rendering.renderer.fetch.URLFetchError` with no HTTP status or with a 4xx status
+    which is not marked as transient. Server errors and transport errors such as timeouts are assumed to be transient
+    and are not remembered.
+
+    :param ttl: default 300, the number of seconds to remember a missing tile for
+    :type ttl: float
+    :param max_entries: default 65536, the maximum number of missing tiles to remember
+    :type max_entries: integer
+
+    .. py:attribute:: hits
+
+        The number of calls to :py:meth:`check` which found a remembered failure.
+
+    """
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl if ttl is not None else 300
+        self.max_entries = max_entries or 65536
+        self.hits = 0
+
+        self._lock = threading.Lock()
+        self._failures = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._failures)
+
+    def check(self, key):
+        """Raise the remembered failure for *key* if there is one which has not expired."""
+        with self._lock:
+            entry = self._failures.get(key)
+            if entry is None:
+                return
+            expires, error = entry
+            if expires <= time.time():
+                del self._failures[key]
+                return
+            self.hits += 1
+        raise error
+
+    def put(self, key, error):
+        """Remember that fetching *key* failed with the :py:class:`URLFetchError` *error* if it indicates a missing
+        tile.
+
+        """
+        if getattr(error, 'transient', False):
+            return
+        status = getattr(error, 'status', None)
+        if status is not None and (status < 400 or status >= 500):
+            return
+
+        with self._lock:
+            self._failures.pop(key, None)
+            while len(self._failures) >= self.max_entries:
+                self._failures.popitem(last=False)
+            self._failures[key] = (time.time() + self.ttl, error)
+
+    def clear(self):
+        """Forget all remembered failures."""
+        with self._lock:
+            self._failures.clear()
+            self.hits = 0
+
+_default_negative_cache = None
+_default_negative_cache_lock = threading.Lock()
+
+def default_negative_cache():
+    """Return the process-wide :py:class:`NegativeCache` shared by renderers which have not been given one explicitly."""
+    global _default_negative_cache
+    with _default_negative_cache_lock:
+        if _default_negative_cache is None:
+            _default_negative_cache = NegativeCache()
+        return _default_negative_cache
+
+_default_surface_cache = None
+_default_surface_cache_lock = threading.Lock()
+
+def default_surface_cache():
+    """Return the process-wide :py:class:`SurfaceCache` shared by renderers which have not been given one explicitly."""
+    global _default_surface_cache
+    with _default_surface_cache_lock:
+        if _default_surface_cache is None:
+            _default_surface_cache = SurfaceCache()
+        return _default_surface_cache
@@ -1,23 +1,25 @@
+import functools
 import math
 import logging
 import StringIO
 import sys
+import threading
+import time
 
 import cairo
 import numpy as np
-from osgeo.osr import SpatialReference
 from PIL import Image
-import httplib2
 
-from foldbeam.rendering.renderer.base import RendererBase, set_geo_transform
-from foldbeam.rendering.renderer.decorator import reproject_from_native_spatial_reference
+from foldbeam.rendering.renderer.base import RendererBase, set_geo_transform, _get_placeholder_surface
+from foldbeam.rendering.renderer.decorator import reproject_from_native_spatial_reference, spatial_reference_pair_cache
+from foldbeam.rendering.renderer.fetch import HTTPFetcher, URLFetchError, FetchTimeoutError
+from foldbeam.rendering.renderer.fetch import default_fetch_pool
+from foldbeam.rendering.renderer.fetch import _TRANSPORT_ERRORS, _transient_fetch_error
+from foldbeam.rendering.renderer.tile_cache import default_negative_cache, default_surface_cache
+from foldbeam.rendering.srs import spatial_reference_registry
 
 log = logging.getLogger()
 
-class URLFetchError(Exception):
-    """An error raised by a custom URL fetchber for TileFetcher if the URL could not be fetchbed."""
-    pass
-
 class TileFetcher(RendererBase):
     """Render from slippy map tile URLs.
 
@@ -27,20 +29,73 @@ class TileFetcher(RendererBase):
     In addition to ``{x}`` and ``{y}``, ``{quadkey}`` can be used to support Bing-style quad keys. See
     http://msdn.microsoft.com/en-us/library/bb259689.aspx.
 
+    Requests may be spread over several hosts by including ``{s}`` in the pattern. It is replaced by one of the
+    strings in *subdomains*, chosen from the tile co-ordinates so that a given tile is always fetched from the same
+    host. The default subdomains are ``'a'``, ``'b'`` and ``'c'``.
+
     .. note::
         If no spatial reference is specified, it will default to EPSG:3857. Similarly, if no bounds are specified, the
         default is to assume the bounds of this projection (x and y being +/- 20037508.34 metres).
 
-    The default URL pattern is ``http://otile1.mqcdn.com/tiles/1.0.0/osm/{zoom}/{x}/{y}.jpg`` which will load tiles
-    from the MapQuest servers.
+    The default URL pattern is ``http://otile{s}.mqcdn.com/tiles/1.0.0/osm/{zoom}/{x}/{y}.jpg`` with subdomains
+    ``'1'`` to ``'4'`` which will load tiles from the MapQuest servers.
 
     If the *url_fetcher* parameter is specified, it is a callable which takes a single string giving a URL as the first
     argument and returns a sequence of bytes for the URL contents. It can raise URLFetchError if the resource is not
     available. If no fetcher is provided, :py:func:`default_url_fetcher` is used. The fetcher callable must be
     thread-safe.
+
+    Tiles are fetched concurrently by a :py:class:`foldbeam.rendering.renderer.fetch.FetchPool`, which bounds both
+    the total number of fetches in flight and the number in flight to any one host. If *fetch_pool* is not specified,
+    the process-wide pool returned by :py:func:`foldbeam.rendering.renderer.fetch.default_fetch_pool` is used. Tiles
+    are always painted in the same order regardless of the order in which they arrive. Tiles nearest the centre of the
+    area being rendered are fetched first so that, if the render is progressive or has a deadline, the most visible
+    area is filled first. Queued fetches for tiles which will no longer be painted are cancelled.
+
+    Decoded tiles are kept in a :py:class:`foldbeam.rendering.renderer.tile_cache.SurfaceCache` keyed by URL so that
+    a tile needed by successive renders is fetched and decoded only once. If *surface_cache* is not specified, the
+    process-wide cache returned by :py:func:`foldbeam.rendering.renderer.tile_cache.default_surface_cache` is used.
+
+    If *tile_cache* is specified, it is an object with ``get(url)`` and ``put(url, data)`` methods, such as
+    :py:class:`foldbeam.rendering.renderer.tile_cache.DiskTileCache`, which is consulted for the raw tile data before
+    the URL fetcher is called and is given the data for each tile which is fetched.
+
+    Tiles which could not be fetched because they do not exist upstream are remembered for a while in a
+    :py:class:`foldbeam.rendering.renderer.tile_cache.NegativeCache` and subsequent requests for them fail immediately
+    without contacting the server. If *negative_cache* is not specified, the process-wide cache returned by
+    :py:func:`foldbeam.rendering.renderer.tile_cache.default_negative_cache` is used.
+
+    Concurrent requests for the same tile URL, whether from one render or from renders on other threads sharing the
+    fetch pool, are coalesced by the :py:class:`foldbeam.rendering.renderer.fetch.FetchPool` before being queued so
+    that the tile is fetched only once and every requester receives the same data or error.
+
+    If *fallback_to_parent* is True, a tile which cannot be fetched does not cause the render to fail. Instead, the
+    nearest ancestor of the tile at a lower zoom level which is already in the surface cache is scaled up and painted
+    in its place. If there is no such ancestor, the tile is left transparent. If *progressive* is True, the render does
+    not wait for tiles which are not already cached at all: ancestors are painted in place of any tiles which have not
+    arrived by the time the render callable is called. The fetches continue in the background and so the exact tiles
+    are swapped in by later renders as they arrive.
+
+    If *deadline* is specified, it is the maximum time in seconds which :py:meth:`render_callable` will wait for tiles
+    to arrive. Tiles which have not arrived by then are painted with a parent tile if *fallback_to_parent* is True
+    and one is cached or with the placeholder pattern otherwise. If *missed_tile_callback* is specified, it is called
+    with a list of (x, y, zoom) tuples giving the tiles which missed the deadline. If *request_timeout* is specified
+    and no *url_fetcher* is given, it is the socket timeout in seconds for each tile request.
+
+    A tile whose fetch fails with a transient error, such as a request timing out or a dropped connection, never causes
+    the render to fail. It is treated as if it had missed the deadline. Transport errors raised by a custom
+    *url_fetcher* are converted to transient :py:class:`URLFetchError` instances.
+
+    If *tile_source* is specified, it is an object such as
+    :py:class:`foldbeam.rendering.renderer.mbtiles.MBTilesSource` with a ``get_tile(x, y, zoom)`` method returning the
+    data for a tile or `None` if it has no such tile. It is consulted before the URL fetcher. If *url_pattern* is not
+    also specified, tiles are loaded only from the tile source, tiles missing from it are treated as if their fetch
+    had raised URLFetchError and the tile source's ``url_pattern`` attribute is used to name tiles in caches.
     
     :param url_pattern: default is to use MapQuest, a pattern for calculating the URL to load tiles from
     :type url_pattern: string
+    :param subdomains: the strings to substitute for ``{s}`` in *url_pattern*
+    :type subdomains: sequence of string or None
     :param spatial_reference: default EPSG:3857, the native spatial reference for the tiles
     :type spatial_reference: osgeo.osr.SpatialReference or None
     :param tile_size: default (256, 256), the width and height of one tile in pixels
@@ -49,11 +104,45 @@ class TileFetcher(RendererBase):
     :type bounds: tuple of float or None
     :param url_fetcher: which callable to use for URL fetching
     :type url_fetcher: callable or None
+    :param fetch_pool: which pool to fetch tiles with
+    :type fetch_pool: :py:class:`foldbeam.rendering.renderer.fetch.FetchPool` or None
+    :param surface_cache: which cache to keep decoded tiles in
+    :type surface_cache: :py:class:`foldbeam.rendering.renderer.tile_cache.SurfaceCache` or None
+    :param tile_cache: a persistent cache of raw tile data
+    :type tile_cache: :py:class:`foldbeam.rendering.renderer.tile_cache.DiskTileCache` or None
+    :param negative_cache: which cache to remember missing tiles in
+    :type negative_cache: :py:class:`foldbeam.rendering.renderer.tile_cache.NegativeCache` or None
+    :param fallback_to_parent: default False, paint cached ancestors in place of tiles which cannot be fetched
+    :type fallback_to_parent: bool
+    :param progressive: default False, do not wait for tiles which are not already cached
+    :type progressive: bool
+    :param tile_source: a local source of tiles to consult before fetching URLs
+    :type tile_source: :py:class:`foldbeam.rendering.renderer.mbtiles.MBTilesSource` or None
+    :param deadline: default None, the maximum time in seconds to wait for tiles
+    :type deadline: float or None
+    :param request_timeout: default None, the timeout in seconds for each request made by the default URL fetcher
+    :type request_timeout: float or None
+    :param missed_tile_callback: default None, called with the tiles which missed the deadline
+    :type missed_tile_callback: callable or None
     """
 
-    def __init__(self, url_pattern=None, spatial_reference=None, tile_size=None, bounds=None, url_fetcher=None):
+    def __init__(self, url_pattern=None, spatial_reference=None, tile_size=None, bounds=None, url_fetcher=None,
+            fetch_pool=None, surface_cache=None, tile_cache=None, fallback_to_parent=False, progressive=False,
+            tile_source=None, deadline=None, request_timeout=None, missed_tile_callback=None, negative_cache=None,
+            subdomains=None):
         super(TileFetcher, self).__init__()
-        self.url_pattern = url_pattern or 'http://otile1.mqcdn.com/tiles/1.0.0/osm/{zoom}/{x}/{y}.jpg'
+        self.tile_source = tile_source
+        if url_pattern is None and tile_source is not None:
+            self.url_pattern = tile_source.url_pattern
+            self._fetch_urls = False
+        elif url_pattern is None:
+            self.url_pattern = 'http://otile{s}.mqcdn.com/tiles/1.0.0/osm/{zoom}/{x}/{y}.jpg'
+            subdomains = subdomains or ('1', '2', '3', '4')
+            self._fetch_urls = True
+        else:
+            self.url_pattern = url_pattern
+            self._fetch_urls = True
+        self.subdomains = tuple(subdomains or ('a', 'b', 'c'))
         self.tile_size = tile_size or (256, 256)
 
         self.bounds = bounds or (-20037508.34, 20037508.34, 20037508.34, -20037508.34)
@@ -62,14 +151,28 @@ class TileFetcher(RendererBase):
         if spatial_reference is not None:
             self.native_spatial_reference = spatial_reference
         else:
-            self.native_spatial_reference = SpatialReference()
-            self.native_spatial_reference.ImportFromEPSG(3857)
+            self.native_spatial_reference = spatial_reference_registry().from_epsg(3857)
 
-        self._fetch_url = url_fetcher or default_url_fetcher
+        if url_fetcher is not None:
+            self._fetch_url = url_fetcher
+        elif request_timeout is not None:
+            self._fetch_url = HTTPFetcher(timeout=request_timeout)
+        else:
+            self._fetch_url = default_url_fetcher
+        self._fetch_pool = fetch_pool or default_fetch_pool()
+        self._surface_cache = surface_cache or default_surface_cache()
+        self._tile_cache = tile_cache
+        self._negative_cache = negative_cache or default_negative_cache()
+
+        self.fallback_to_parent = fallback_to_parent
+        self.progressive = progressive
+        self.deadline = deadline
+        self.missed_tile_callback = missed_tile_callback
 
     @reproject_from_native_spatial_reference
     def render_callable(self, context, spatial_reference=None):
-        if spatial_reference is not None and not spatial_reference.IsSame(self.native_spatial_reference):
+        if spatial_reference is not None and spatial_reference is not self.native_spatial_reference and \
+                not spatial_reference_pair_cache().get(spatial_reference, self.native_spatial_reference).is_same:
             raise ValueError('TileFetcher asked to render tile from incompatible spatial reference.')
 
         # Calculate the distance in projection co-ordinates of one device pixel
@@ -98,60 +201,211 @@ class TileFetcher(RendererBase):
         min_x, min_y = tl
         max_x, max_y = br
 
-        tiles_to_fetch = []
-        for x in range(min_x, max_x+1):
-            # wrap the x co-ordinate in the number of tiles
-            wrapped_x = x % n_tiles
-            if wrapped_x < 0:
-                wrapped_x += n_tiles
+        # The centre of the clip area in tile co-ordinates
+        centre_x, centre_y = self._projection_to_tile(0.5*(min_px+max_px), 0.5*(min_py+max_py), zoom)
 
+        tiles = []
+        for x in range(min_x, max_x+1):
             for y in range(min_y, max_y+1):
                 # skip out of range y-tiles
                 if y < 0 or y >= n_tiles:
                     continue
 
-                # Calculate quadkey
-                quadkey = ''
-                for bit in xrange(zoom):
-                    v = ((x>>bit)&0x1) + ((((y)>>bit)&0x1)<<1)
-                    quadkey = str(v) + quadkey
-                
-                url = self.url_pattern.format(x=wrapped_x, y=y, zoom=zoom, quadkey=quadkey)
-                tiles_to_fetch.append((x,y,url,self._fetch_url(url)))
+                # only fetch those tiles which have not already been decoded
+                url = self._tile_url(x, y, zoom)
+                tiles.append((x, y, url, self._surface_cache.get(url)))
+
+        # submit fetches in order of the distance of the tile's centre from the centre of the clip area
+        futures = {}
+        for x, y, url, surface in tiles:
+            if surface is not None:
+                continue
+            load = functools.partial(self._load_tile_surface, tile=(self._wrap_x(x, zoom), y, zoom))
+            priority = math.hypot(x + 0.5 - centre_x, y + 0.5 - centre_y)
+            futures[(x, y)] = self._fetch_pool.submit(load, url, priority=priority, key=url)
+
+        tiles_to_fetch = [(x, y, surface, futures.get((x, y))) for x, y, url, surface in tiles]
+
+        # unless rendering progressively, wait for the fetches to complete or the deadline to pass re-raising the first
+        # error in painting order if we cannot fall back to a parent tile
+        missed_tiles = set()
+        if not self.progressive:
+            deadline_time = time.time() + self.deadline if self.deadline is not None else None
+            for x, y, surface, future in tiles_to_fetch:
+                if future is None:
+                    continue
+                try:
+                    future.result(max(0, deadline_time - time.time()) if deadline_time is not None else None)
+                except FetchTimeoutError:
+                    missed_tiles.add((x, y))
+                except URLFetchError as e:
+                    if e.transient:
+                        log.warning('Transient error fetching tile %s: %s' % (future.url, e))
+                        missed_tiles.add((x, y))
+                    elif not self.fallback_to_parent:
+                        # the render has failed and so no other tiles are needed
+                        [f.cancel() for f in futures.itervalues()]
+                        raise
+                    log.warning('Falling back to parent of tile %s: %s' % (future.url, e))
+
+        if len(missed_tiles) > 0:
+            # queued fetches for tiles which missed the deadline are no longer needed
+            [futures[tile].cancel() for tile in missed_tiles]
+
+            log.warning('%s tile(s) missed the render deadline or timed out' % (len(missed_tiles),))
+            if self.missed_tile_callback is not None:
+                self.missed_tile_callback([(x, y, zoom) for x, y, _, _ in tiles_to_fetch if (x, y) in missed_tiles])
+
+        # Get the user space distance of one output device unit for the placeholder pattern
+        placeholder_scale = max(*[abs(x) for x in context.user_to_device_distance(1, 1)])
 
         def f():
-            # render the tiles as they come in
-            for x, y, url, data in tiles_to_fetch:
-                # load the tile into a cairo surface
-                surface = _cairo_surface_from_data(data)
-
-                # what extents should this tile have?
-                tile_x, tile_y, tile_w, tile_h = self._tile_extents(x, y, zoom)
-
-                tile_x_scale = surface.get_width() / tile_w
-                tile_y_scale = -surface.get_height() / tile_h
-
-                # set up the tile as a source
-                context.set_source_surface(surface)
-                context.get_source().set_matrix(cairo.Matrix(
-                    xx = tile_x_scale,
-                    yy = tile_y_scale,
-                    x0 = -tile_x * tile_x_scale,
-                    y0 = -tile_y * tile_y_scale + surface.get_height()
-                ))
-
-                # we need to set the extend options to avoid interpolating towards zero-alpha at the edges
-                context.get_source().set_extend(cairo.EXTEND_PAD)
-
-                # draw the tile itself. We disable antialiasing because if the tile slightly overlaps an output
-                # pixel we want the interpolation of the tile to do the smoothing, not the rasteriser
-                context.save()
-                context.set_antialias(cairo.ANTIALIAS_NONE)
-                context.rectangle(tile_x, tile_y, tile_w, tile_h)
-                context.fill()
-                context.restore()
-
-        return f    
+            # render the tiles in the order they were enumerated
+            for x, y, surface, future in tiles_to_fetch:
+                transient = False
+                if surface is None and future.done():
+                    try:
+                        surface = future.result()
+                    except URLFetchError as e:
+                        transient = e.transient
+
+                if surface is not None:
+                    self._paint_tile(context, surface, x, y, zoom)
+                    continue
+
+                # the tile is either missing or has not arrived yet
+                ancestor = None
+                if self.fallback_to_parent or self.progressive:
+                    ancestor = self._cached_ancestor(x, y, zoom)
+                if ancestor is not None:
+                    surface, ancestor_x, ancestor_y, ancestor_zoom = ancestor
+                    self._paint_tile(context, surface, ancestor_x, ancestor_y, ancestor_zoom,
+                            clip=self._tile_extents(x, y, zoom))
+                elif (x, y) in missed_tiles or transient:
+                    self._paint_placeholder(context, placeholder_scale, x, y, zoom)
+
+        return f
+
+    def _paint_tile(self, context, surface, x, y, zoom, clip=None):
+        """Paint the tile *surface* which has tile co-ordinates (*x*, *y*) at *zoom*. If *clip* is not None, it is a
+        tuple (minx, miny, width, height) giving the region of the tile to paint in projection co-ords.
+
+        """
+        # what extents should this tile have?
+        tile_x, tile_y, tile_w, tile_h = self._tile_extents(x, y, zoom)
+
+        tile_x_scale = surface.get_width() / tile_w
+        tile_y_scale = -surface.get_height() / tile_h
+
+        # set up the tile as a source
+        context.set_source_surface(surface)
+        context.get_source().set_matrix(cairo.Matrix(
+            xx = tile_x_scale,
+            yy = tile_y_scale,
+            x0 = -tile_x * tile_x_scale,
+            y0 = -tile_y * tile_y_scale + surface.get_height()
+        ))
+
+        # we need to set the extend options to avoid interpolating towards zero-alpha at the edges
+        context.get_source().set_extend(cairo.EXTEND_PAD)
+
+        # draw the tile itself. We disable antialiasing because if the tile slightly overlaps an output
+        # pixel we want the interpolation of the tile to do the smoothing, not the rasteriser
+        context.save()
+        context.set_antialias(cairo.ANTIALIAS_NONE)
+        context.rectangle(*(clip or (tile_x, tile_y, tile_w, tile_h)))
+        context.fill()
+        context.restore()
+
+    def _paint_placeholder(self, context, placeholder_scale, x, y, zoom):
+        """Paint the placeholder pattern over the extent of tile (*x*, *y*) at *zoom*."""
+        context.save()
+        context.set_source_surface(_get_placeholder_surface())
+        context.get_source().set_extend(cairo.EXTEND_REPEAT)
+        context.get_source().set_matrix(cairo.Matrix(xx=placeholder_scale, yy=-placeholder_scale))
+        context.rectangle(*self._tile_extents(x, y, zoom))
+        context.fill()
+        context.restore()
+
+    def _cached_ancestor(self, x, y, zoom):
+        """Return a tuple (surface, x, y, zoom) for the nearest ancestor of tile (*x*, *y*) at *zoom* whose decoded
+        surface is in the surface cache or None if there is no such ancestor.
+
+        """
+        for ancestor_zoom in xrange(zoom-1, -1, -1):
+            shift = zoom - ancestor_zoom
+            ancestor_x, ancestor_y = x >> shift, y >> shift
+            surface = self._surface_cache.get(self._tile_url(ancestor_x, ancestor_y, ancestor_zoom), count=False)
+            if surface is not None:
+                return (surface, ancestor_x, ancestor_y, ancestor_zoom)
+        return None
+
+    def _tile_url(self, x, y, zoom):
+        """Return the URL for tile (*x*, *y*) at *zoom*. The x co-ordinate is wrapped into range."""
+
+        wrapped_x = self._wrap_x(x, zoom)
+
+        # Calculate quadkey
+        quadkey = ''
+        for bit in xrange(zoom):
+            v = ((x>>bit)&0x1) + ((((y)>>bit)&0x1)<<1)
+            quadkey = str(v) + quadkey
+
+        # Choose a subdomain deterministically from the tile co-ordinates
+        subdomain = self.subdomains[(wrapped_x + y) % len(self.subdomains)]
+
+        return self.url_pattern.format(x=wrapped_x, y=y, zoom=zoom, quadkey=quadkey, s=subdomain)
+
+    def _wrap_x(self, x, zoom):
+        """Wrap the x co-ordinate of a tile at *zoom* in the number of tiles."""
+        n_tiles = 1<<zoom
+        wrapped_x = x % n_tiles
+        if wrapped_x < 0:
+            wrapped_x += n_tiles
+        return wrapped_x
+
+    def _load_tile_surface(self, url, tile):
+        """Fetch and decode the tile at *url* and add it to the surface cache. The tile co-ordinates are given by
+        *tile*, a tuple (x, y, zoom).
+
+        """
+
+        # the tile may have been loaded by another render since we last looked, a lookup which render_callable has
+        # already counted as a miss
+        surface = self._surface_cache.get(url, count=False)
+        if surface is not None:
+            return surface
+
+        surface = _cairo_surface_from_data(self._fetch_tile_data(url, tile))
+        self._surface_cache.put(url, surface)
+        return surface
+
+    def _fetch_tile_data(self, url, tile):
+        """Return the raw data for the tile at *url*, consulting the tile source and tile cache if there are any."""
+        if self.tile_source is not None:
+            data = self.tile_source.get_tile(*tile)
+            if data is not None:
+                return data
+            if not self._fetch_urls:
+                raise URLFetchError('Tile %s not present in tile source' % (url,))
+
+        if self._tile_cache is not None:
+            data = self._tile_cache.get(url)
+            if data is not None:
+                return data
+
+        self._negative_cache.check(url)
+        try:
+            data = self._fetch_url(url)
+        except URLFetchError as e:
+            self._negative_cache.put(url, e)
+            raise
+        except _TRANSPORT_ERRORS as e:
+            raise _transient_fetch_error(url, e), None, sys.exc_info()[2]
+
+        if self._tile_cache is not None:
+            self._tile_cache.put(url, data)
+        return data
 
     def _tile_extents(self, tx, ty, zoom):
         """Return a tuple (minx, miny, width, height) giving the extents of a tile in projection co-ords."""
@@ -175,26 +429,51 @@ class TileFetcher(RendererBase):
         # Map projection co-ords into tile co-ords
         return tuple([x[0] / x[1] for x in zip((px-self.bounds[0], self.bounds[2]-py), tile_size)])
 
+_default_http_fetcher = None
+_default_http_fetcher_lock = threading.Lock()
+
 def default_url_fetcher(url):
     """The default URL fetcher to use in :py:class:`TileFetcher`. If there is an error fetching the URL a URLFetchError
     is raised.
 
+    All calls share a single process-wide :py:class:`foldbeam.rendering.renderer.fetch.HTTPFetcher` and so re-use
+    keep-alive connections to the tile servers.
+
     """
-    http = httplib2.Http()
-    rep, content = http.request(url, 'GET')
-    if rep.status != 200:
-        raise URLFetchError(str(rep.status) + ' ' + rep.reason)
-    return content
+    global _default_http_fetcher
+    with _default_http_fetcher_lock:
+        if _default_http_fetcher is None:
+            _default_http_fetcher = HTTPFetcher()
+    return _default_http_fetcher(url)
 
 def _cairo_surface_from_data(data):
-    # load via the PIL
-    image = Image.open(StringIO.StringIO(data)).convert('RGBA')
+    # load via the PIL, converting only those modes which are neither RGB nor RGBA
+    image = Image.open(StringIO.StringIO(data))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
     imw, imh = image.size
 
-    # swizzle RGBA -> BGRA
-    image = Image.frombuffer('RGBA', (imw, imh), image.tostring(), 'raw', 'BGRA', 0, 1)
-
-    # write into a Cairo surface
-    surface = cairo.ImageSurface.create_for_data(np.array(image), cairo.FORMAT_ARGB32, imw, imh)
+    # the only copy out of the PIL
+    pixels = np.asarray(image)
+
+    # write directly into the Cairo surface's buffer swizzling RGB(A) -> BGRA
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, imw, imh)
+    surface_array = _image_surface_to_strided_array(surface)
+    if image.mode == 'RGB':
+        surface_array[:,:,:3] = pixels[:,:,::-1]
+        surface_array[:,:,3] = 255
+    else:
+        # Cairo expects pre-multiplied alpha
+        alpha = pixels[:,:,3:]
+        surface_array[:,:,:3] = (pixels[:,:,2::-1] * alpha.astype(np.uint16) + 127) // 255
+        surface_array[:,:,3:] = alpha
+    surface.mark_dirty()
 
     return surface
+
+def _image_surface_to_strided_array(image_surface):
+    """Return a height x width x 4 numpy array pointing to the pixels of a Cairo image surface, respecting its stride."""
+    assert(image_surface.get_format() == cairo.FORMAT_ARGB32)
+    return np.ndarray(
+            shape=(image_surface.get_height(), image_surface.get_width(), 4), dtype=np.uint8,
+            buffer=image_surface.get_data(), strides=(image_surface.get_stride(), 4, 1))
@@ -0,0 +1,349 @@
+"""Engines for warping a raster from one spatial reference to another.
+
+An engine has a single method, ``warp(source_dataset, output_dataset, pair, resampling)``, which reprojects the GDAL
+dataset *source_dataset* into *output_dataset*. Both datasets must have their geo transforms set. The *pair* is a
+spatial reference pair as returned by :py:meth:`foldbeam.rendering.renderer.decorator.SpatialReferencePairCache.get`
+for the output and source spatial references respectively. The *resampling* parameter is one of the ``gdal.GRA_*``
+constants and gives the resampling the caller would like; engines may support only a subset.
+
+"""
+import collections
+import logging
+import threading
+
+import numpy as np
+from osgeo import gdal
+
+log = logging.getLogger()
+
+class ReprojectImageEngine(object):
+    """Warp using :py:func:`gdal.ReprojectImage`. This is the default engine."""
+
+    def warp(self, source_dataset, output_dataset, pair, resampling=None):
+        gdal.ReprojectImage(
+                source_dataset, output_dataset,
+                pair.native_wkt, pair.wkt,
+                resampling if resampling is not None else gdal.GRA_Bilinear
+        )
+
+class GDALWarpEngine(object):
+    """Warp using :py:func:`gdal.Warp`, which can spread the work of a single warp over several threads.
+
+    If the last band of the source is an alpha band, :py:func:`gdal.Warp` warps it as the source's alpha rather than
+    as a colour band. The last band of the output then receives the warped alpha.
+
+    :param num_threads: default ``'ALL_CPUS'``, the number of threads used for each warp
+    :type num_threads: integer or string
+    :param warp_memory_limit: default None, the size in megabytes of the working buffer for each warp or `None` for
+        GDAL's default
+    :type warp_memory_limit: float or None
+    :param resampling: default None, one of the ``gdal.GRA_*`` constants overriding the resampling requested by the
+        caller
+    :type resampling: integer or None
+    :raises RuntimeError: if the installed GDAL does not provide :py:func:`gdal.Warp`
+
+    """
+    def __init__(self, num_threads=None, warp_memory_limit=None, resampling=None):
+        if not hasattr(gdal, 'Warp'):
+            raise RuntimeError('GDALWarpEngine requires gdal.Warp from GDAL 2.1 or later but GDAL %s is installed' %
+                    (gdal.VersionInfo('RELEASE_NAME'),))
+        self.num_threads = num_threads or 'ALL_CPUS'
+        self.warp_memory_limit = warp_memory_limit
+        self.resampling = resampling
+
+    def warp(self, source_dataset, output_dataset, pair, resampling=None):
+        if self.resampling is not None:
+            resampling = self.resampling
+        elif resampling is None:
+            resampling = gdal.GRA_Bilinear
+
+        # gdal.Warp treats a source alpha band as a mask and so the output needs an alpha band to receive it
+        alpha = source_dataset.RasterCount == output_dataset.RasterCount and \
+                source_dataset.GetRasterBand(source_dataset.RasterCount).GetColorInterpretation() == gdal.GCI_AlphaBand
+        if alpha:
+            output_alpha_band = output_dataset.GetRasterBand(output_dataset.RasterCount)
+            old_interpretation = output_alpha_band.GetColorInterpretation()
+            output_alpha_band.SetColorInterpretation(gdal.GCI_AlphaBand)
+
+        options = gdal.WarpOptions(
+                srcSRS=pair.native_wkt, dstSRS=pair.wkt,
+                resampleAlg=resampling,
+                multithread=True,
+                warpOptions=['NUM_THREADS=%s' % (self.num_threads,)],
+                warpMemoryLimit=self.warp_memory_limit,
+                dstAlpha=alpha,
+        )
+        try:
+            if gdal.Warp(output_dataset, source_dataset, options=options) is None:
+                raise RuntimeError('gdal.Warp failed: %s' % (gdal.GetLastErrorMsg(),))
+        finally:
+            # the output may be pooled and reused by an engine which does not expect an alpha band
+            if alpha:
+                output_alpha_band.SetColorInterpretation(old_interpretation)
+
+class WarpGridEngine(object):
+    """Warp using a cached grid of projected co-ordinates and a vectorised NumPy gather.
+
+    For each output pixel, the engine needs the co-ordinates of the corresponding point in the source spatial
+    reference. Rather than transforming every pixel, the engine transforms a sparse grid of points every *grid_step*
+    output pixels and bilinearly interpolates between them.
+
+    Grids are computed and cached for square frames of *frame_size* output pixels. Frames are laid out on a lattice
+    fixed by the output pixel size and by the offset of pixel boundaries from the origin of the output spatial
+    reference. Outputs at the same resolution whose pixels line up, such as the tiles of one zoom level, therefore
+    share frames and so warping a tile near one which has already been warped is usually a single array remap. Since
+    the grids hold co-ordinates in the source spatial reference rather than source pixel co-ordinates, they are also
+    independent of the source raster's geometry. Outputs with rotated geo transforms have a grid computed for them
+    alone which is not cached.
+
+    Only the window of the source raster which the output covers is read.
+
+    Only nearest-neighbour and bilinear resampling are supported. Any other resampling is treated as bilinear.
+
+    :param grid_step: default 16, the spacing in output pixels of the grid of transformed points
+    :type grid_step: integer
+    :param frame_size: default 512, the width and height in output pixels of the frames grids are cached for
+    :type frame_size: integer
+    :param max_bytes: default 64MiB, the maximum number of bytes of grids to cache
+    :type max_bytes: integer
+
+    """
+    def __init__(self, grid_step=None, frame_size=None, max_bytes=None):
+        self.grid_step = grid_step or 16
+        self.frame_size = frame_size or 512
+        self.max_bytes = max_bytes or 64 * 1024 * 1024
+
+        self._lock = threading.Lock()
+        self._grids = collections.OrderedDict()
+        self._size = 0
+
+    def warp(self, source_dataset, output_dataset, pair, resampling=None):
+        width, height = output_dataset.RasterXSize, output_dataset.RasterYSize
+        projected_x, projected_y = self._projected_grid(pair, tuple(output_dataset.GetGeoTransform()), width, height)
+
+        # transform the grid into source pixel co-ordinates
+        sx, ssx, srx, sy, sry, ssy = _invert_geo_transform(source_dataset.GetGeoTransform())
+        source_x = sx + projected_x * ssx + projected_y * srx
+        source_y = sy + projected_x * sry + projected_y * ssy
+
+        source_width, source_height = source_dataset.RasterXSize, source_dataset.RasterYSize
+        with np.errstate(invalid='ignore'):
+            valid = (source_x >= 0) & (source_x < source_width) & (source_y >= 0) & (source_y < source_height)
+        if not np.any(valid):
+            for band_idx in xrange(output_dataset.RasterCount):
+                output_dataset.GetRasterBand(band_idx+1).Fill(0)
+            return
+
+        # read only the window of the source covering the valid points with a margin of one pixel for interpolation
+        x0 = max(0, int(np.floor(source_x[valid].min())) - 1)
+        y0 = max(0, int(np.floor(source_y[valid].min())) - 1)
+        x1 = min(source_width, int(np.floor(source_x[valid].max())) + 2)
+        y1 = min(source_height, int(np.floor(source_y[valid].max())) + 2)
+        source = source_dataset.ReadAsArray(x0, y0, x1-x0, y1-y0)
+        if source.ndim == 2:
+            source = source[np.newaxis,:,:]
+        grid = (np.where(valid, source_x - x0, np.nan), np.where(valid, source_y - y0, np.nan))
+
+        if resampling == gdal.GRA_NearestNeighbour:
+            output = _remap_nearest(source, grid)
+        else:
+            output = _remap_bilinear(source, grid)
+
+        for band_idx in xrange(output.shape[0]):
+            output_dataset.GetRasterBand(band_idx+1).WriteArray(output[band_idx])
+
+    def _projected_grid(self, pair, geo_transform, width, height):
+        """Return a pair of arrays giving the source projection x and y co-ordinates of each output pixel centre."""
+        ox, osx, orx, oy, ory, osy = geo_transform
+        if orx != 0 or ory != 0 or osx == 0 or osy == 0:
+            return self._compute_grid(pair, geo_transform, width, height)
+
+        # the offset of pixel boundaries from the origin, in pixels, and the position of the output on the lattice
+        col, row = ox / osx, oy / osy
+        phase_x, phase_y = round(col - round(col), 3), round(row - round(row), 3)
+        col, row = int(round(col - phase_x)), int(round(row - phase_y))
+        lattice = (osx, osy, phase_x, phase_y)
+
+        # copy the overlap of each frame with the output
+        frame_size = self.frame_size
+        projected_x = np.empty((height, width), dtype=np.float64)
+        projected_y = np.empty((height, width), dtype=np.float64)
+        for frame_row in xrange(row // frame_size, (row + height - 1) // frame_size + 1):
+            for frame_col in xrange(col // frame_size, (col + width - 1) // frame_size + 1):
+                frame_x, frame_y = self._frame(pair, lattice, frame_col, frame_row)
+                c0, c1 = max(col, frame_col * frame_size), min(col + width, (frame_col + 1) * frame_size)
+                r0, r1 = max(row, frame_row * frame_size), min(row + height, (frame_row + 1) * frame_size)
+                fc, fr = frame_col * frame_size, frame_row * frame_size
+                projected_x[r0-row:r1-row, c0-col:c1-col] = frame_x[r0-fr:r1-fr, c0-fc:c1-fc]
+                projected_y[r0-row:r1-row, c0-col:c1-col] = frame_y[r0-fr:r1-fr, c0-fc:c1-fc]
+
+        return projected_x, projected_y
+
+    def _frame(self, pair, lattice, frame_col, frame_row):
+        """Return the, possibly cached, grid for the frame at (*frame_col*, *frame_row*) on *lattice*."""
+        key = (pair.wkt, pair.native_wkt, lattice, frame_col, frame_row)
+        with self._lock:
+            grid = self._grids.pop(key, None)
+            if grid is not None:
+                self._grids[key] = grid
+                return grid
+
+        osx, osy, phase_x, phase_y = lattice
+        frame_size = self.frame_size
+        geo_transform = (
+                (frame_col * frame_size + phase_x) * osx, osx, 0.0,
+                (frame_row * frame_size + phase_y) * osy, 0.0, osy)
+        grid = self._compute_grid(pair, geo_transform, frame_size, frame_size)
+
+        nbytes = grid[0].nbytes + grid[1].nbytes
+        if nbytes > self.max_bytes:
+            return grid
+
+        with self._lock:
+            old = self._grids.pop(key, None)
+            if old is not None:
+                self._size -= old[0].nbytes + old[1].nbytes
+            while self._size + nbytes > self.max_bytes:
+                _, evicted = self._grids.popitem(last=False)
+                self._size -= evicted[0].nbytes + evicted[1].nbytes
+            self._grids[key] = grid
+            self._size += nbytes
+        return grid
+
+    def _compute_grid(self, pair, geo_transform, width, height):
+        """Return a pair of float64 arrays giving the source projection x and y co-ordinates of each pixel centre of a
+        *width* by *height* output with *geo_transform*.
+
+        """
+        # output pixel co-ordinates of the sparse grid, always including the last row and column
+        grid_x = np.unique(np.append(np.arange(0, width, self.grid_step), width-1)).astype(np.float64)
+        grid_y = np.unique(np.append(np.arange(0, height, self.grid_step), height-1)).astype(np.float64)
+        pixel_x, pixel_y = np.meshgrid(grid_x + 0.5, grid_y + 0.5)
+
+        # transform the grid from output projection co-ordinates into source projection co-ordinates
+        ox, osx, orx, oy, ory, osy = geo_transform
+        points = zip((ox + pixel_x * osx + pixel_y * orx).flat, (oy + pixel_x * ory + pixel_y * osy).flat)
+        transformed = np.array(pair.transformation.TransformPoints(points), dtype=np.float64)
+        projected_x = transformed[:,0].reshape(pixel_x.shape)
+        projected_y = transformed[:,1].reshape(pixel_x.shape)
+
+        # points which could not be transformed are marked as invalid
+        invalid = ~np.isfinite(projected_x) | ~np.isfinite(projected_y) | \
+                (np.abs(projected_x) > 1e30) | (np.abs(projected_y) > 1e30)
+        projected_x[invalid] = np.nan
+        projected_y[invalid] = np.nan
+
+        # interpolate the sparse grid to every output pixel
+        return (
+            _interpolate_grid(projected_x, grid_x, grid_y, width, height),
+            _interpolate_grid(projected_y, grid_x, grid_y, width, height),
+        )
+
+def _invert_geo_transform(geo_transform):
+    """Return the inverse of the GDAL *geo_transform*, mapping projection co-ordinates to pixel co-ordinates."""
+    inverse = gdal.InvGeoTransform(tuple(geo_transform))
+    if inverse is not None and len(inverse) == 2:
+        # GDAL 1.x returns a success flag along with the inverse
+        success, inverse = inverse
+        if not success:
+            inverse = None
+    if inverse is None:
+        raise ValueError('Source geo transform is not invertible')
+    return inverse
+
+def _interpolate_grid(values, grid_x, grid_y, width, height):
+    """Bilinearly interpolate *values* sampled at output pixels *grid_x* by *grid_y* to a *width* by *height* array."""
+
+    # fractional indices into the sparse grid for each output pixel
+    fx = np.interp(np.arange(width), grid_x, np.arange(len(grid_x)))
+    fy = np.interp(np.arange(height), grid_y, np.arange(len(grid_y)))
+    ix0 = np.minimum(np.floor(fx).astype(np.intp), len(grid_x)-1)
+    iy0 = np.minimum(np.floor(fy).astype(np.intp), len(grid_y)-1)
+    ix1 = np.minimum(ix0+1, len(grid_x)-1)
+    iy1 = np.minimum(iy0+1, len(grid_y)-1)
+    wx = (fx - ix0)[np.newaxis,:]
+    wy = (fy - iy0)[:,np.newaxis]
+
+    top = values[iy0,:][:,ix0] * (1-wx) + values[iy0,:][:,ix1] * wx
+    bottom = values[iy1,:][:,ix0] * (1-wx) + values[iy1,:][:,ix1] * wx
+    return top * (1-wy) + bottom * wy
+
+def _remap_nearest(source, grid):
+    """Gather from the (bands, height, width) array *source* at the nearest pixel to each point in *grid*."""
+    source_x, source_y = grid
+    bands, source_height, source_width = source.shape
+
+    with np.errstate(invalid='ignore'):
+        valid = (source_x >= 0) & (source_x < source_width) & (source_y >= 0) & (source_y < source_height)
+    ix = np.floor(source_x[valid]).astype(np.intp)
+    iy = np.floor(source_y[valid]).astype(np.intp)
+
+    output = np.zeros((bands,) + source_x.shape, dtype=source.dtype)
+    output[:,valid] = source[:,iy,ix]
+    return output
+
+def _remap_bilinear(source, grid):
+    """Bilinearly interpolate the (bands, height, width) array *source* at each point in *grid*."""
+    source_x, source_y = grid
+    bands, source_height, source_width = source.shape
+
+    with np.errstate(invalid='ignore'):
+        valid = (source_x >= 0) & (source_x < source_width) & (source_y >= 0) & (source_y < source_height)
+
+    # sample positions relative to pixel centres, clamped to the edge of the source
+    px = np.clip(source_x[valid] - 0.5, 0, source_width-1)
+    py = np.clip(source_y[valid] - 0.5, 0, source_height-1)
+    ix0 = np.floor(px).astype(np.intp)
+    iy0 = np.floor(py).astype(np.intp)
+    ix1 = np.minimum(ix0+1, source_width-1)
+    iy1 = np.minimum(iy0+1, source_height-1)
+    wx = px - ix0
+    wy = py - iy0
+
+    top = source[:,iy0,ix0] * (1-wx) + source[:,iy0,ix1] * wx
+    bottom = source[:,iy1,ix0] * (1-wx) + source[:,iy1,ix1] * wx
+
+    output = np.zeros((bands,) + source_x.shape, dtype=source.dtype)
+    output[:,valid] = np.round(top * (1-wy) + bottom * wy)
+    return output
+
+def read_into_image_surface(dataset, surface, band_list=None):
+    """Read the 8-bit bands of *dataset* straight into the pixels of the Cairo ARGB32 image *surface*, which must be
+    the same size. No intermediate copies of the image are made.
+
+    The pixels of a Cairo image surface are stored as blue, green, red and alpha bytes. Each pixel is set from the
+    bands in *band_list* in that order.
+
+    :param dataset: the dataset to read
+    :type dataset: :py:class:`gdal.Dataset`
+    :param surface: the surface to write into
+    :type surface: :py:class:`cairo.ImageSurface`
+    :param band_list: default ``(1, 2, 3, 4)``, the one-based indices of the blue, green, red and alpha bands
+    :type band_list: sequence of four integers
+
+    """
+    band_list = band_list or (1, 2, 3, 4)
+    width, height = surface.get_width(), surface.get_height()
+    assert (dataset.RasterXSize, dataset.RasterYSize) == (width, height)
+
+    # a view of the surface's pixels with one plane per byte of each pixel
+    surface.flush()
+    planes = np.ndarray(shape=(4, height, width), dtype=np.uint8, buffer=surface.get_data(),
+            strides=(1, surface.get_stride(), 4))
+    for plane, band_idx in zip(planes, band_list):
+        dataset.GetRasterBand(band_idx).ReadAsArray(buf_obj=plane)
+    surface.mark_dirty()
+
+_default_engine = ReprojectImageEngine()
+
+def default_warp_engine():
+    """Return the engine used by renderers which do not specify one. Initially this is a
+    :py:class:`ReprojectImageEngine`.
+
+    """
+    return _default_engine
+
+def set_default_warp_engine(engine):
+    """Set the engine returned by :py:func:`default_warp_engine`."""
+    global _default_engine
+    _default_engine = engine
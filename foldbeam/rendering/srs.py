@@ -0,0 +1,177 @@
+"""A registry of canonical spatial references.
+
+Constructing an :py:class:`osr.SpatialReference` from a definition and comparing two of them with
+:py:meth:`osr.SpatialReference.IsSame` are both comparatively expensive. The registry interns spatial references so
+that each distinct spatial reference is constructed once and is identified by a hashable key. Two spatial references
+are the same exactly when their keys are equal.
+
+"""
+import collections
+import threading
+
+from osgeo import osr
+
+class SpatialReferenceRegistry(object):
+    """A thread-safe registry of interned spatial references.
+
+    Each spatial reference seen by the registry is normalised to its WKT. The first time a WKT is seen it is compared
+    with :py:meth:`osr.SpatialReference.IsSame` against the spatial references already registered. If it matches one of
+    them, it shares that spatial reference's key. Otherwise it becomes a new canonical spatial reference whose key is its
+    WKT. After that, looking up the key for the same WKT, for the same definition or for a canonical spatial reference
+    needs only a dictionary lookup.
+
+    The canonical spatial references returned by the registry are shared between all of its users and so must be
+    treated as read-only. Use :py:meth:`osr.SpatialReference.Clone` to obtain a copy which may be modified.
+
+    The registry remembers at most *max_spatial_references* canonical spatial references and *max_definitions*
+    user-supplied definitions and WKTs, forgetting the least recently used first. A spatial reference which is
+    registered again after being forgotten may be given a different, although equally valid, key.
+
+    :param max_definitions: default 1024, the maximum number of user-supplied definitions and WKTs to remember
+    :type max_definitions: integer
+    :param max_spatial_references: default 256, the maximum number of canonical spatial references to remember
+    :type max_spatial_references: integer
+
+    """
+    def __init__(self, max_definitions=None, max_spatial_references=None):
+        self.max_definitions = max_definitions or 1024
+        self.max_spatial_references = max_spatial_references or 256
+
+        self._lock = threading.Lock()
+
+        # canonical spatial references by key, in order of least recent use
+        self._canonical = collections.OrderedDict()
+
+        # keys by normalised WKT, by the id() of canonical spatial references and by user-supplied definition
+        self._keys_by_wkt = collections.OrderedDict()
+        self._keys_by_id = {}
+        self._keys_by_definition = collections.OrderedDict()
+
+    def from_user_input(self, definition):
+        """Return the canonical spatial reference for *definition*, which is anything accepted by
+        :py:meth:`osr.SpatialReference.SetFromUserInput` such as ``'EPSG:27700'``, a PROJ.4 string or WKT. The returned
+        spatial reference must not be modified.
+
+        :raises ValueError: if *definition* cannot be parsed
+
+        """
+        return self._from_definition(('user', definition), lambda srs: srs.SetFromUserInput(definition))
+
+    def from_epsg(self, code):
+        """Return the canonical spatial reference for the EPSG *code*. The returned spatial reference must not be
+        modified.
+
+        :raises ValueError: if *code* is unknown
+
+        """
+        return self._from_definition(('epsg', int(code)), lambda srs: srs.ImportFromEPSG(int(code)))
+
+    def from_proj4(self, proj4):
+        """Return the canonical spatial reference for the PROJ.4 definition *proj4*. The returned spatial reference
+        must not be modified.
+
+        :raises ValueError: if *proj4* cannot be parsed
+
+        """
+        return self._from_definition(('proj4', proj4), lambda srs: srs.ImportFromProj4(proj4))
+
+    def intern(self, spatial_reference):
+        """Return the canonical spatial reference which is the same as *spatial_reference*. The returned spatial
+        reference must not be modified.
+
+        """
+        return self._canonical_for_wkt(spatial_reference.ExportToWkt())[1]
+
+    def key(self, spatial_reference):
+        """Return the hashable key for *spatial_reference*, registering it if necessary."""
+        key = self._keys_by_id.get(id(spatial_reference))
+        if key is not None and self._canonical.get(key) is spatial_reference:
+            return key
+        return self._canonical_for_wkt(spatial_reference.ExportToWkt())[0]
+
+    def is_same(self, spatial_reference, other_spatial_reference):
+        """Return True if *spatial_reference* and *other_spatial_reference* are the same spatial reference."""
+        if spatial_reference is other_spatial_reference:
+            return True
+        return self.key(spatial_reference) == self.key(other_spatial_reference)
+
+    def _from_definition(self, definition, import_definition):
+        with self._lock:
+            key = self._keys_by_definition.pop(definition, None)
+            canonical = self._canonical.get(key) if key is not None else None
+            if canonical is not None:
+                self._keys_by_definition[definition] = key
+                self._touch(key)
+                return canonical
+
+        srs = osr.SpatialReference()
+        if import_definition(srs) != 0:
+            raise ValueError('Invalid spatial reference definition: %r' % (definition[1],))
+        key, canonical = self._canonical_for_wkt(srs.ExportToWkt())
+
+        with self._lock:
+            self._keys_by_definition[definition] = key
+            while len(self._keys_by_definition) > self.max_definitions:
+                self._keys_by_definition.popitem(last=False)
+        return canonical
+
+    def _canonical_for_wkt(self, wkt):
+        """Return a tuple giving the key and canonical spatial reference for *wkt*, registering it if necessary."""
+        with self._lock:
+            key = self._keys_by_wkt.pop(wkt, None)
+            canonical = self._canonical.get(key) if key is not None else None
+            if canonical is not None:
+                self._keys_by_wkt[wkt] = key
+                self._touch(key)
+                return key, canonical
+            candidates = self._canonical.items()
+
+        # compare against the canonical spatial references without holding the lock since IsSame is slow
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(wkt)
+        match = _find_same(srs, candidates)
+
+        with self._lock:
+            if match is None or match[0] not in self._canonical:
+                # compare against any spatial references registered, and forgotten, since we looked
+                compared = set(k for k, _ in candidates)
+                match = _find_same(srs, [item for item in self._canonical.items() if item[0] not in compared])
+            if match is None:
+                match = (intern(wkt), srs)
+                self._canonical[match[0]] = srs
+                self._keys_by_id[id(srs)] = match[0]
+                while len(self._canonical) > self.max_spatial_references:
+                    self._forget(self._canonical.iterkeys().next())
+            else:
+                self._touch(match[0])
+
+            self._keys_by_wkt.pop(wkt, None)
+            self._keys_by_wkt[wkt] = match[0]
+            while len(self._keys_by_wkt) > self.max_definitions:
+                self._keys_by_wkt.popitem(last=False)
+            return match
+
+    def _touch(self, key):
+        # must be called with the lock held
+        self._canonical[key] = self._canonical.pop(key)
+
+    def _forget(self, key):
+        # must be called with the lock held
+        srs = self._canonical.pop(key)
+        del self._keys_by_id[id(srs)]
+        for keys in (self._keys_by_wkt, self._keys_by_definition):
+            for k in [k for k, v in keys.iteritems() if v == key]:
+                del keys[k]
+
+def _find_same(srs, candidates):
+    """Return the first (key, spatial reference) pair in *candidates* which is the same as *srs* or None."""
+    for key, canonical in candidates:
+        if canonical.IsSame(srs):
+            return (key, canonical)
+    return None
+
+_default_registry = SpatialReferenceRegistry()
+
+def spatial_reference_registry():
+    """Return the process-wide :py:class:`SpatialReferenceRegistry`."""
+    return _default_registry
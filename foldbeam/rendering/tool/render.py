@@ -3,11 +3,10 @@ import logging
 import sys
 
 import cairo
-import httplib2
 from osgeo import gdal, gdal_array
 from osgeo.osr import SpatialReference
 
-from foldbeam.rendering.renderer import TileFetcher, set_geo_transform
+from foldbeam.rendering.renderer import DiskTileCache, HTTPFetcher, MBTilesSource, TileFetcher, set_geo_transform
 
 logging.basicConfig(level=logging.WARNING)
 
@@ -51,6 +50,12 @@ parser.add_argument('-e', '--height', metavar='NUMBER', type=int, nargs='?',
         dest='height', help='the height of the map in pixels (default: use width and projection aspect)')
 parser.add_argument('--cache-dir', metavar='DIRECTORY', type=str, nargs='?',
         dest='cache_dir', help='cache downloaded tiles into this directory')
+parser.add_argument('--tile-cache-dir', metavar='DIRECTORY', type=str, nargs='?',
+        dest='tile_cache_dir', help='keep a size-bounded cache of tiles in this directory')
+parser.add_argument('--tile-cache-size', metavar='MEGABYTES', type=int, nargs='?',
+        default=256, dest='tile_cache_size', help='the maximum size of the tile cache (default: 256)')
+parser.add_argument('--mbtiles', metavar='FILENAME', type=str, nargs='?',
+        dest='mbtiles', help='render tiles from the MBTiles file at FILENAME rather than downloading them')
 parser.add_argument('--aerial', action='store_true', default=False, help='use aerial imagery')
 parser.add_argument('--like', metavar='FILENAME', type=str, nargs='?',
         dest='like_filename', help='Match projection and region from the raster at FILENAME')
@@ -110,21 +115,23 @@ def run(args):
     size = (args.width, args.height)
 
     url_patterns = {
-        'osm': 'http://otile1.mqcdn.com/tiles/1.0.0/osm/{zoom}/{x}/{y}.jpg',
-        'aerial': 'http://ecn.t1.tiles.virtualearth.net/tiles/a{quadkey}.jpeg?g=1647',
-        #'aerial': 'http://oatile1.mqcdn.com/tiles/1.0.0/sat/{zoom}/{x}/{y}.jpg',
+        'osm': ('http://otile{s}.mqcdn.com/tiles/1.0.0/osm/{zoom}/{x}/{y}.jpg', '1234'),
+        'aerial': ('http://ecn.t{s}.tiles.virtualearth.net/tiles/a{quadkey}.jpeg?g=1647', '0123'),
+        #'aerial': ('http://oatile{s}.mqcdn.com/tiles/1.0.0/sat/{zoom}/{x}/{y}.jpg', '1234'),
     }
 
-    def url_fetcher(url):
-        http = httplib2.Http(args.cache_dir)
-        rep, content = http.request(url, 'GET')
-        if rep.status != 200:
-            raise foldbeam.renderer.URLFetchError(str(rep.status) + ' ' + rep.reason)
-        return content
+    tile_cache = None
+    if args.tile_cache_dir is not None:
+        tile_cache = DiskTileCache(args.tile_cache_dir, max_bytes=args.tile_cache_size * 1024 * 1024)
 
-    renderer = TileFetcher(
-            url_pattern=url_patterns['aerial' if args.aerial else 'osm'],
-            url_fetcher=url_fetcher)
+    if args.mbtiles is not None:
+        renderer = TileFetcher(tile_source=MBTilesSource(args.mbtiles))
+    else:
+        url_pattern, subdomains = url_patterns['aerial' if args.aerial else 'osm']
+        renderer = TileFetcher(
+                url_pattern=url_pattern, subdomains=subdomains,
+                url_fetcher=HTTPFetcher(cache=args.cache_dir),
+                tile_cache=tile_cache)
 
 
     if args.output.endswith('.tiff'):
@@ -2,6 +2,7 @@ import json
 
 from flask import url_for, make_response
 
+from foldbeam.rendering.srs import spatial_reference_registry
 from .flaskapp import app, resource
 from .util import *
 
@@ -58,9 +59,7 @@ def map(username, map_id):
 @resource
 def get_map(username, map_id):
     user, map_ = get_user_and_map_or_404(username, map_id)
-    from osgeo import osr
-    srs = osr.SpatialReference()
-    srs.SetFromUserInput(map_.srs)
+    srs = spatial_reference_registry().from_user_input(map_.srs)
 
     layer_tiles = [url_for_map_tms_tiles(map_)]
 
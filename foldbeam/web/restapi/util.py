@@ -3,6 +3,7 @@ import urlparse
 
 from flask import abort, request, url_for
 
+from foldbeam.rendering.srs import spatial_reference_registry
 from foldbeam.web import model
 
 def _url_for(name, **kwargs):
@@ -128,9 +129,10 @@ def update_map(m, request):
     if 'name' in request:
         m.name = request['name']
     if 'srs' in request:
-        from osgeo import osr
-        srs = osr.SpatialReference()
-        srs.SetFromUserInput(request['srs'])
+        try:
+            srs = spatial_reference_registry().from_user_input(request['srs'])
+        except ValueError:
+            abort(400) # Bad request
         srs_proj4 = srs.ExportToProj4()
         if srs_proj4 is None or srs_proj4 == '':
             abort(400) # Bad request
@@ -1,6 +1,8 @@
+import threading
 import unittest
 
 import cairo
+from osgeo import gdal, ogr
 from osgeo.osr import SpatialReference
 import numpy as np
 
@@ -58,3 +60,195 @@ class TestBoundary(unittest.TestCase):
         self.assertTrue(uk_latlng.contains_point(-4.333333, 53.283333)) # Anglesey
         self.assertTrue(not uk_latlng.contains_point(-8.47, 51.897222)) # Cork
         self.assertTrue(not uk_latlng.contains_point(2.3508, 48.8567)) # Paris
+
+    def test_concurrent_transform(self):
+        srs = SpatialReference()
+        srs.ImportFromEPSG(27700) # British national grid
+
+        # a boundary not constructed from an envelope so that its transformations are not memoised
+        uk_area = core.Boundary(core.boundary_from_envelope(core.Envelope(0, 700000, 1300000, 0, srs)).geometry.Clone())
+
+        latlng_srs = SpatialReference()
+        latlng_srs.ImportFromEPSG(4326) # WGS 84 lat/lng
+        expected = uk_area.transform_to(latlng_srs, 1000).geometry.GetEnvelope()
+
+        old_opt = gdal.GetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION')
+        results, errors = [], []
+        def transform():
+            try:
+                for _ in range(20):
+                    results.append(uk_area.transform_to(latlng_srs, 1000).geometry.GetEnvelope())
+            except Exception as e: # pragma: no coverage
+                errors.append(e)
+
+        threads = [threading.Thread(target=transform) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 8 * 20)
+        for envelope in results:
+            self.assertEqual(envelope, expected)
+        self.assertEqual(gdal.GetConfigOption('OGR_ENABLE_PARTIAL_REPROJECTION'), old_opt)
+
+    def test_contains_points(self):
+        srs = SpatialReference()
+        srs.ImportFromEPSG(27700) # British national grid
+        uk_area = core.boundary_from_envelope(core.Envelope(0, 700000, 1300000, 0, srs))
+
+        latlng_srs = SpatialReference()
+        latlng_srs.ImportFromEPSG(4326) # WGS 84 lat/lng
+        uk_latlng = uk_area.transform_to(latlng_srs, 1000, 1.0)
+
+        xs = np.array([-1.826189, -3.07, -5.716111, -4.333333, -8.47, 2.3508, 100.0])
+        ys = np.array([51.178844, 58.64, 50.068611, 53.283333, 51.897222, 48.8567, 0.0])
+        mask = uk_latlng.contains_points(xs, ys)
+        self.assertEqual(mask.dtype, np.bool_)
+        self.assertEqual(list(mask), [True, True, True, True, False, False, False])
+
+        # agrees with contains_point for a grid of points straddling the boundary's edge
+        xs, ys = np.meshgrid(np.linspace(-12, 6, 37), np.linspace(47, 63, 33))
+        mask = uk_latlng.contains_points(xs, ys)
+        self.assertEqual(mask.shape, xs.shape)
+        for x, y, inside in zip(xs.flat, ys.flat, mask.flat):
+            self.assertEqual(inside, uk_latlng.contains_point(x, y))
+
+    def test_contains_points_with_hole(self):
+        srs = SpatialReference()
+        srs.ImportFromEPSG(4326) # WGS 84 lat/lng
+        geometry = ogr.CreateGeometryFromWkt(
+                'MULTIPOLYGON (((0 0, 10 0, 10 10, 0 10, 0 0), (4 4, 6 4, 6 6, 4 6, 4 4)), ((20 0, 30 0, 25 10, 20 0)))')
+        geometry.AssignSpatialReference(srs)
+        boundary = core.Boundary(geometry)
+
+        mask = boundary.contains_points([1, 5, 9, 15, 25, 21], [1, 5, 9, 5, 2, 9])
+        self.assertEqual(list(mask), [True, False, True, False, True, False])
+        self.assertEqual(boundary.contains_points([], []).shape, (0,))
+
+class TestTransformEnvelopes(unittest.TestCase):
+    def setUp(self):
+        self.bng = SpatialReference()
+        self.bng.ImportFromEPSG(27700) # British national grid
+        self.latlng = SpatialReference()
+        self.latlng.ImportFromEPSG(4326) # WGS 84 lat/lng
+
+        self.envelopes = np.array([
+            (0, 700000, 1300000, 0),
+            (400000, 500000, 300000, 200000),
+            (100000, 110000, 50000, 40000),
+        ], dtype=np.float64)
+
+    def test_matches_envelope_transform_to(self):
+        result = core.transform_envelopes(self.envelopes, self.bng, self.latlng, 1000)
+        self.assertEqual(result.shape, (3, 4))
+        for row, (left, right, top, bottom) in zip(result, self.envelopes):
+            expected = core.Envelope(left, right, top, bottom, self.bng).transform_to(self.latlng, 1000)
+            self.assertTrue(np.allclose(
+                row, (expected.left, expected.right, expected.top, expected.bottom), atol=1e-6))
+
+    def test_mixed_sizes(self):
+        # each envelope in a batch is densified as if it had been transformed alone
+        result = core.transform_envelopes(self.envelopes, self.bng, self.latlng, 1000)
+        for idx in xrange(self.envelopes.shape[0]):
+            alone = core.transform_envelopes(self.envelopes[idx:idx+1], self.bng, self.latlng, 1000)
+            self.assertTrue(np.all(result[idx] == alone[0]))
+
+    def test_corners_only(self):
+        result = core.transform_envelopes(self.envelopes[1:2], self.bng, self.latlng)
+        expected = core.Envelope(400000, 500000, 300000, 200000, self.bng).transform_to(self.latlng)
+        self.assertTrue(np.allclose(
+            result[0], (expected.left, expected.right, expected.top, expected.bottom), atol=1e-6))
+
+    def test_empty(self):
+        self.assertEqual(core.transform_envelopes(np.zeros((0, 4)), self.bng, self.latlng).shape, (0, 4))
+
+class TestEnvelopeArray(unittest.TestCase):
+    def setUp(self):
+        self.srs = SpatialReference()
+        self.srs.ImportFromEPSG(27700) # British national grid
+        self.grid = core.EnvelopeArray.grid(core.Envelope(0, 400, 200, 0, self.srs), 4, 2)
+
+    def test_envelope_has_slots(self):
+        envelope = core.Envelope(0, 1, 1, 0, self.srs)
+        self.assertFalse(hasattr(envelope, '__dict__'))
+
+    def test_grid(self):
+        self.assertEqual(len(self.grid), 8)
+        self.assertTrue(self.grid.array.flags['C_CONTIGUOUS'])
+        cell = self.grid[1 * 4 + 2]
+        self.assertEqual((cell.left, cell.right, cell.top, cell.bottom), (200, 300, 100, 0))
+        self.assertIs(cell.spatial_reference, self.srs)
+        self.assertTrue(np.all(self.grid.area() == 100 * 100))
+
+    def test_intersects_and_contains(self):
+        probe = core.Envelope(50, 150, 150, 50, self.srs)
+        self.assertEqual(list(self.grid.intersects(probe)), [True, True, False, False, True, True, False, False])
+        self.assertEqual(list(self.grid.contains(probe)), [False] * 8)
+        self.assertEqual(list(self.grid[self.grid.intersects(probe)].contains(
+            core.Envelope(60, 70, 140, 130, self.srs))), [True, False, False, False])
+
+    def test_intersection_and_union(self):
+        probe = core.Envelope(50, 150, 150, 50, self.srs)
+        intersection = self.grid.intersection(probe)
+        self.assertTrue(np.allclose(intersection.array[0], (50, 100, 150, 100)))
+        self.assertTrue(np.all(np.isnan(intersection.array[2])))
+        self.assertTrue(np.allclose(intersection.area()[[0, 1, 4, 5]], 50 * 50))
+
+        union = self.grid.union(probe)
+        self.assertTrue(np.allclose(union.array[3], (50, 400, 200, 50)))
+        bounds = self.grid.bounds()
+        self.assertEqual((bounds.left, bounds.right, bounds.top, bounds.bottom), (0, 400, 200, 0))
+
+    def test_from_envelopes(self):
+        envelopes = core.EnvelopeArray.from_envelopes(list(self.grid))
+        self.assertTrue(np.all(envelopes.array == self.grid.array))
+        self.assertIs(envelopes.spatial_reference, self.srs)
+
+class TestBoundaryTransformCache(unittest.TestCase):
+    def setUp(self):
+        self.bng = SpatialReference()
+        self.bng.ImportFromEPSG(27700) # British national grid
+        self.latlng = SpatialReference()
+        self.latlng.ImportFromEPSG(4326) # WGS 84 lat/lng
+
+        self.cache = core.boundary_transform_cache()
+        self.cache.clear()
+
+    def test_repeated_transform(self):
+        first = core.Envelope(0, 700000, 1300000, 0, self.bng).transform_to(self.latlng, 1000)
+        second = core.Envelope(0, 700000, 1300000, 0, self.bng).transform_to(self.latlng, 1000)
+        self.assertEqual((first.left, first.right, first.top, first.bottom),
+                (second.left, second.right, second.top, second.bottom))
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_key(self):
+        boundary = core.boundary_from_envelope(core.Envelope(0, 700000, 1300000, 0, self.bng))
+        boundary.transform_to(self.latlng, 1000)
+        boundary.transform_to(self.latlng, 2000)
+        core.boundary_from_envelope(core.Envelope(0, 700000, 1300000, 1, self.bng)).transform_to(self.latlng, 1000)
+        self.assertEqual(self.cache.misses, 3)
+
+        # an equivalent spatial reference constructed separately shares the cached transformation
+        other_latlng = SpatialReference()
+        other_latlng.ImportFromProj4('+proj=longlat +datum=WGS84 +no_defs')
+        transformed = boundary.transform_to(other_latlng, 1000)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertTrue(transformed.contains_point(-1.826189, 51.178844)) # Stonehenge
+
+    def test_arbitrary_boundaries_are_not_cached(self):
+        boundary = core.boundary_from_envelope(core.Envelope(0, 700000, 1300000, 0, self.bng))
+        core.Boundary(boundary.geometry.Clone()).transform_to(self.latlng, 1000)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.misses, 0)
+
+    def test_missing_spatial_reference(self):
+        boundary = core.boundary_from_envelope(core.Envelope(0, 700000, 1300000, 0, self.bng))
+        boundary.geometry.AssignSpatialReference(None)
+        self.assertRaises(core.ProjectionError, boundary.transform_to, self.latlng, 1000)
+        self.assertEqual(len(self.cache), 0)
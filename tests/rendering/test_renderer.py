@@ -1,6 +1,13 @@
+import BaseHTTPServer
 import hashlib
 import logging
 import StringIO
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import os
 import sys
@@ -10,7 +17,10 @@ sys.modules['pysqlite2'] = pyspatialite
 
 import cairo
 from filecache import filecache
+import numpy as np
+from osgeo import gdal
 from osgeo.osr import SpatialReference
+from PIL import Image
 
 import httplib2
 
@@ -26,7 +36,13 @@ import geoalchemy
 from foldbeam.rendering.geometry import IterableGeometry, GeoAlchemyGeometry
 from foldbeam.rendering.renderer import set_geo_transform, default_url_fetcher
 from foldbeam.rendering.renderer import TileFetcher, Geometry
+from foldbeam.rendering.renderer import FetchPool, HTTPFetcher, URLFetchError, SurfaceCache, DiskTileCache
+from foldbeam.rendering.renderer import SingleFlight, MBTilesSource, NegativeCache, BufferPool
 from foldbeam.rendering.renderer import Wrapped, Layers
+from foldbeam.rendering.renderer import spatial_reference_pair_cache
+from foldbeam.rendering.renderer import ReprojectImageEngine, GDALWarpEngine, WarpGridEngine, read_into_image_surface
+from foldbeam.rendering.renderer.tile_fetcher import _cairo_surface_from_data
+from foldbeam.rendering.renderer.decorator import _affine_native_to_target_matrix
 
 from ..utils import surface_hash, output_surface
 
@@ -197,6 +213,804 @@ class TestTileFetcher(unittest.TestCase):
         output_surface(surface, 'tilefetcher_british_national_grid_ultra_wide')
         self.assertEqual(surface_hash(surface)/10000, 2651)
 
+class TestFetchPool(unittest.TestCase):
+    def test_results_in_order(self):
+        pool = FetchPool(max_workers=4)
+        futures = [pool.submit(lambda url: url.upper(), 'http://example.com/%s' % (i,)) for i in range(20)]
+        self.assertEqual([f.result() for f in futures], ['HTTP://EXAMPLE.COM/%s' % (i,) for i in range(20)])
+
+    def test_max_per_host(self):
+        lock = threading.Lock()
+        in_flight = {}
+        max_in_flight = {}
+
+        def fetcher(url):
+            host = url.split('/')[2]
+            with lock:
+                in_flight[host] = in_flight.get(host, 0) + 1
+                max_in_flight[host] = max(max_in_flight.get(host, 0), in_flight[host])
+            time.sleep(0.01)
+            with lock:
+                in_flight[host] -= 1
+            return url
+
+        pool = FetchPool(max_workers=8, max_per_host=2)
+        futures = [pool.submit(fetcher, 'http://host%s/%s' % (i%2, i)) for i in range(32)]
+        [f.result() for f in futures]
+        self.assertEqual(max_in_flight, {'host0': 2, 'host1': 2})
+
+    def test_priority_and_cancel(self):
+        pool = FetchPool(max_workers=1)
+        release = threading.Event()
+        order = []
+
+        def fetcher(url):
+            if url == 'blocker':
+                release.wait()
+            order.append(url)
+            return url
+
+        blocker = pool.submit(fetcher, 'blocker')
+        while not blocker._started:
+            time.sleep(0.001)
+
+        futures = [pool.submit(fetcher, str(priority), priority=priority) for priority in (3, 1, 4, 2, 0)]
+        self.assertTrue(futures[2].cancel())
+        release.set()
+        [f.result() for f in futures if f is not futures[2]]
+
+        self.assertEqual(order, ['blocker', '0', '1', '2', '3'])
+        self.assertRaises(URLFetchError, futures[2].result)
+        self.assertFalse(futures[0].cancel())
+
+    def test_coalesces_by_key(self):
+        pool = FetchPool(max_workers=1)
+        release = threading.Event()
+        order = []
+
+        def fetcher(url):
+            if url == 'blocker':
+                release.wait()
+            order.append(url)
+            return url
+
+        blocker = pool.submit(fetcher, 'blocker')
+        while not blocker._started:
+            time.sleep(0.001)
+
+        first = pool.submit(fetcher, 'a', key='a')
+        second = pool.submit(fetcher, 'a', key='a')
+        other = pool.submit(fetcher, 'b', key='b')
+        self.assertTrue(first is second)
+        self.assertEqual(pool.coalesced, 1)
+
+        # the shared fetch is still wanted by the second submission
+        self.assertFalse(first.cancel())
+        self.assertTrue(other.cancel())
+        release.set()
+
+        self.assertEqual(second.result(), 'a')
+        self.assertEqual(order, ['blocker', 'a'])
+
+        # a completed fetch is not shared with later submissions
+        self.assertEqual(pool.submit(fetcher, 'a', key='a').result(), 'a')
+        self.assertEqual(order, ['blocker', 'a', 'a'])
+        self.assertEqual(pool.coalesced, 1)
+
+    def test_error_propagates(self):
+        def fetcher(url):
+            raise URLFetchError('404 Not Found')
+
+        pool = FetchPool()
+        self.assertRaises(URLFetchError, pool.submit(fetcher, 'http://example.com/').result)
+
+class TestSingleFlight(unittest.TestCase):
+    def test_coalesces_concurrent_calls(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow(url):
+            calls.append(url)
+            started.set()
+            release.wait()
+            return url + ' data'
+
+        pool = FetchPool(max_workers=4)
+        futures = [pool.submit(lambda url: single_flight.do(url, slow, url), 'http://example.com/') for _ in range(4)]
+        started.wait()
+        while single_flight.shared < 3:
+            time.sleep(0.001)
+        release.set()
+
+        self.assertEqual([f.result() for f in futures], ['http://example.com/ data'] * 4)
+        self.assertEqual(calls, ['http://example.com/'])
+        self.assertEqual(single_flight.calls, 1)
+
+        # once complete, the next call runs again
+        release.set()
+        single_flight.do('http://example.com/', slow, 'http://example.com/')
+        self.assertEqual(len(calls), 2)
+
+    def test_shares_errors(self):
+        def fail(url):
+            raise URLFetchError('404 Not Found')
+        self.assertRaises(URLFetchError, SingleFlight().do, 'http://example.com/', fail, 'http://example.com/')
+
+class _TileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/slow/'):
+            # respond only after the client has given up
+            time.sleep(0.5)
+        elif not self.path.startswith('/tiles/'):
+            self.send_error(404)
+            return
+        body = self.path
+        try:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except socket.error:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+class TestHTTPFetcher(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _TileRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%s' % (self.server.server_port,)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch(self):
+        fetcher = HTTPFetcher(pool_size=2)
+        pool = FetchPool(max_workers=4)
+        futures = [pool.submit(fetcher, '%s/tiles/%s' % (self.base_url, i)) for i in range(16)]
+        self.assertEqual([f.result() for f in futures], ['/tiles/%s' % (i,) for i in range(16)])
+
+    def test_missing(self):
+        fetcher = HTTPFetcher()
+        self.assertRaises(URLFetchError, fetcher, self.base_url + '/missing')
+
+    def test_timeout(self):
+        fetcher = HTTPFetcher(timeout=0.1)
+        try:
+            fetcher(self.base_url + '/slow/0')
+        except URLFetchError as e:
+            self.assertTrue(e.transient)
+            self.assertTrue(isinstance(e.cause, socket.error))
+        else: # pragma: no coverage
+            self.fail('fetch did not time out')
+
+        # transient errors are not remembered as missing tiles
+        cache = NegativeCache()
+        cache.put(self.base_url + '/slow/0', e)
+        self.assertEqual(len(cache), 0)
+
+    def test_request_timeout_falls_back_to_parent(self):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 256, 256)
+        cr = cairo.Context(surface)
+        set_geo_transform(cr, -20037508.34, 20037508.34, 20037508.34, -20037508.34, 256, 256)
+
+        cache = SurfaceCache()
+        renderer = TileFetcher(url_pattern=self.base_url + '/slow/{zoom}/{x}/{y}', request_timeout=0.1,
+                surface_cache=cache, negative_cache=NegativeCache(), fetch_pool=FetchPool(), tile_size=(128, 128),
+                fallback_to_parent=True)
+        cache.put(renderer._tile_url(0, 0, 0), _cairo_surface_from_data(solid_tile_data((1,0,0,1))))
+
+        # every tile at zoom 1 times out and the zoom 0 tile is used in their place
+        renderer.render_callable(cr)()
+        data = np.frombuffer(surface.get_data(), dtype=np.uint8).reshape((256, 256, 4))
+        self.assertTrue(np.all(data[:,:,2] == 255))
+        self.assertTrue(np.all(data[:,:,3] == 255))
+
+class TestSurfaceCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        # each 16x16 ARGB32 surface is 1KiB
+        cache = SurfaceCache(max_bytes=3*1024)
+        surfaces = [cairo.ImageSurface(cairo.FORMAT_ARGB32, 16, 16) for _ in range(4)]
+        for idx, surface in enumerate(surfaces[:3]):
+            cache.put(idx, surface)
+        self.assertTrue(cache.get(0) is surfaces[0])
+        cache.put(3, surfaces[3])
+        self.assertTrue(cache.get(1) is None)
+        self.assertTrue(cache.get(0) is surfaces[0])
+        self.assertEqual(cache.stats(), dict(hits=2, misses=1, entries=3, size=3*1024))
+
+    def test_oversized_surface_not_cached(self):
+        cache = SurfaceCache(max_bytes=1024)
+        cache.put('big', cairo.ImageSurface(cairo.FORMAT_ARGB32, 32, 32))
+        self.assertEqual(len(cache), 0)
+
+    def test_tile_fetcher_reuses_decoded_tiles(self):
+        fetched = []
+        def fetcher(url):
+            fetched.append(url)
+            return test_url_fetcher(url)
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 640, 480)
+        cr = cairo.Context(surface)
+        set_geo_transform(cr, -14121.6, -13621.6, 6710515.8, 6710140.8, 640, 480)
+
+        cache = SurfaceCache()
+        renderer = TileFetcher(url_fetcher=fetcher, surface_cache=cache)
+        renderer.render_callable(cr)()
+        n_fetched = len(fetched)
+        self.assertEqual(cache.stats()['misses'], n_fetched)
+        renderer.render_callable(cr)()
+        self.assertEqual(len(fetched), n_fetched)
+        self.assertEqual(cache.stats()['hits'], n_fetched)
+        self.assertEqual(cache.stats()['misses'], n_fetched)
+
+class TestDiskTileCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='tile-cache-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_put(self):
+        cache = DiskTileCache(self.directory)
+        self.assertTrue(cache.get('http://example.com/0/0/0.png') is None)
+        cache.put('http://example.com/0/0/0.png', 'tile data')
+        self.assertEqual(cache.get('http://example.com/0/0/0.png'), 'tile data')
+        self.assertEqual(cache.size, len('tile data'))
+
+        # a second cache sharing the directory sees the same tiles
+        self.assertEqual(DiskTileCache(self.directory).get('http://example.com/0/0/0.png'), 'tile data')
+
+    def test_lru_eviction(self):
+        cache = DiskTileCache(self.directory, max_bytes=300)
+        for idx in range(3):
+            cache.put('tile-%s' % (idx,), 'x' * 100)
+            time.sleep(0.01)
+        cache.get('tile-0')
+        cache.put('tile-3', 'x' * 100)
+        self.assertTrue(cache.get('tile-1') is None)
+        self.assertTrue(cache.get('tile-0') is not None)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.size, 300)
+
+    def test_lfu_eviction(self):
+        cache = DiskTileCache(self.directory, max_bytes=300, policy='lfu')
+        for idx in range(3):
+            cache.put('tile-%s' % (idx,), 'x' * 100)
+        [cache.get('tile-0') for _ in range(3)]
+        [cache.get('tile-2') for _ in range(2)]
+        cache.get('tile-1')
+        cache.put('tile-3', 'x' * 100)
+        self.assertTrue(cache.get('tile-1') is None)
+        self.assertEqual(len(cache), 3)
+
+    def test_accesses_are_batched(self):
+        cache = DiskTileCache(self.directory)
+        self.assertEqual(cache._db().execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+        cache.put('tile-0', 'x' * 100)
+        [cache.get('tile-0') for _ in range(3)]
+        hits = lambda: cache._db().execute('SELECT MAX(hits) FROM tiles').fetchone()[0]
+        self.assertEqual(hits(), 0)
+
+        # accesses are written before the next put
+        cache.put('tile-1', 'x' * 100)
+        self.assertEqual(hits(), 3)
+
+        # or once the flush interval has passed
+        cache.flush_interval = 0
+        cache.get('tile-0')
+        self.assertEqual(hits(), 4)
+
+def solid_tile_data(rgba, size=(256, 256)):
+    """Return PNG data for a tile filled with a solid colour."""
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *size)
+    cr = cairo.Context(surface)
+    cr.set_source_rgba(*rgba)
+    cr.paint()
+    output = StringIO.StringIO()
+    surface.write_to_png(output)
+    return output.getvalue()
+
+class TestTileFetcherFallback(unittest.TestCase):
+    def setUp(self):
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 256, 256)
+        self.cr = cairo.Context(self.surface)
+        set_geo_transform(self.cr, -20037508.34, 20037508.34, 20037508.34, -20037508.34, 256, 256)
+
+        self.zoom_0_data = solid_tile_data((1,0,0,1))
+        self.fetched = []
+        def fetcher(url):
+            self.fetched.append(url)
+            if url == 'test://0/0/0':
+                return self.zoom_0_data
+            raise URLFetchError('404 Not Found')
+        self.fetcher = fetcher
+
+    def test_missing_tile_fails_by_default(self):
+        renderer = TileFetcher(url_pattern='test://{zoom}/{x}/{y}', url_fetcher=self.fetcher,
+                surface_cache=SurfaceCache(), negative_cache=NegativeCache(), tile_size=(128, 128))
+        self.assertRaises(URLFetchError, renderer.render_callable, self.cr)
+
+    def test_parent_fallback(self):
+        renderer = TileFetcher(url_pattern='test://{zoom}/{x}/{y}', url_fetcher=self.fetcher,
+                surface_cache=SurfaceCache(), negative_cache=NegativeCache(), fallback_to_parent=True)
+
+        # render at zoom 0 to populate the cache
+        renderer.render_callable(self.cr)()
+
+        # no tiles at zoom 1 exist but the zoom 0 tile is used in their place
+        renderer.tile_size = (128, 128)
+        self.cr.set_source_rgba(0,0,0,0)
+        self.cr.set_operator(cairo.OPERATOR_SOURCE)
+        self.cr.paint()
+        self.cr.set_operator(cairo.OPERATOR_OVER)
+        renderer.render_callable(self.cr)()
+        output_surface(self.surface, 'tilefetcher_parent_fallback')
+
+        data = np.frombuffer(self.surface.get_data(), dtype=np.uint8).reshape((256, 256, 4))
+        self.assertTrue(np.all(data[:,:,2] == 255))
+        self.assertTrue(np.all(data[:,:,3] == 255))
+
+        # the missing tiles are remembered and not fetched again
+        n_fetched = len(self.fetched)
+        renderer.render_callable(self.cr)()
+        self.assertEqual(len(self.fetched), n_fetched)
+
+    def test_progressive(self):
+        release = threading.Event()
+        def fetcher(url):
+            release.wait()
+            return solid_tile_data((0,0,1,1))
+
+        cache = SurfaceCache()
+        renderer = TileFetcher(url_pattern='test://{zoom}/{x}/{y}', url_fetcher=fetcher, tile_size=(128, 128),
+                surface_cache=cache, negative_cache=NegativeCache(), fetch_pool=FetchPool(), progressive=True)
+        cache.put(renderer._tile_url(0, 0, 0), _cairo_surface_from_data(self.zoom_0_data))
+
+        # the render does not wait for the tiles at zoom 1 and paints their parent in their place
+        renderer.render_callable(self.cr)()
+        data = np.frombuffer(self.surface.get_data(), dtype=np.uint8).reshape((256, 256, 4))
+        self.assertTrue(np.all(data[:,:,2] == 255))
+        self.assertTrue(np.all(data[:,:,3] == 255))
+
+        # once the tiles have arrived, they are painted instead
+        release.set()
+        timeout = time.time() + 5
+        while len(cache) < 5 and time.time() < timeout:
+            time.sleep(0.01)
+        self.assertEqual(len(cache), 5)
+        renderer.render_callable(self.cr)()
+        output_surface(self.surface, 'tilefetcher_progressive')
+        data = np.frombuffer(self.surface.get_data(), dtype=np.uint8).reshape((256, 256, 4))
+        self.assertTrue(np.all(data[:,:,0] == 255))
+        self.assertTrue(np.all(data[:,:,2] == 0))
+
+    def test_timeout_paints_placeholder(self):
+        def fetcher(url):
+            self.fetched.append(url)
+            # the top-left tile times out
+            if url == 'test://1/0/0':
+                raise socket.timeout('timed out')
+            return solid_tile_data((1,0,0,1))
+
+        missed = []
+        negative_cache = NegativeCache()
+        renderer = TileFetcher(url_pattern='test://{zoom}/{x}/{y}', url_fetcher=fetcher, tile_size=(128, 128),
+                surface_cache=SurfaceCache(), negative_cache=negative_cache, missed_tile_callback=missed.extend)
+        renderer.render_callable(self.cr)()
+        output_surface(self.surface, 'tilefetcher_timeout')
+
+        self.assertEqual(missed, [(0, 0, 1)])
+        data = np.frombuffer(self.surface.get_data(), dtype=np.uint8).reshape((256, 256, 4))
+        self.assertTrue(np.all(data[128:,:,2] == 255))
+        self.assertTrue(np.all(data[:128,128:,2] == 255))
+        self.assertFalse(np.all(data[:128,:128,2] == 255))
+        self.assertTrue(np.any(data[:128,:128,3] != 0))
+
+        # the timed out tile is not remembered as missing and is fetched again
+        self.assertEqual(len(negative_cache), 0)
+        n_fetched = len(self.fetched)
+        renderer.render_callable(self.cr)()
+        self.assertEqual(self.fetched[n_fetched:], ['test://1/0/0'])
+
+class TestNegativeCache(unittest.TestCase):
+    def test_remembers_missing(self):
+        cache = NegativeCache(ttl=0.1)
+        cache.check('http://example.com/missing')
+        cache.put('http://example.com/missing', URLFetchError('404 Not Found', status=404))
+        self.assertRaises(URLFetchError, cache.check, 'http://example.com/missing')
+        self.assertEqual(cache.hits, 1)
+
+        # failures expire
+        time.sleep(0.15)
+        cache.check('http://example.com/missing')
+        self.assertEqual(len(cache), 0)
+
+    def test_ignores_server_errors(self):
+        cache = NegativeCache()
+        cache.put('http://example.com/error', URLFetchError('503 Service Unavailable', status=503))
+        cache.check('http://example.com/error')
+        self.assertEqual(len(cache), 0)
+
+class TestTileDecode(unittest.TestCase):
+    def decode(self, mode, colour):
+        output = StringIO.StringIO()
+        Image.new(mode, (8, 8), colour).save(output, 'png')
+        surface = _cairo_surface_from_data(output.getvalue())
+        return np.frombuffer(surface.get_data(), dtype=np.uint8).reshape((8, surface.get_stride()))[:,:32]
+
+    def test_rgb(self):
+        pixels = self.decode('RGB', (10, 20, 30)).reshape((8, 8, 4))
+        self.assertTrue(np.all(pixels == (30, 20, 10, 255)))
+
+    def test_rgba_premultiplied(self):
+        pixels = self.decode('RGBA', (255, 128, 0, 128)).reshape((8, 8, 4))
+        self.assertTrue(np.all(pixels == (0, 64, 128, 128)))
+
+    def test_greyscale(self):
+        pixels = self.decode('L', 200).reshape((8, 8, 4))
+        self.assertTrue(np.all(pixels == (200, 200, 200, 255)))
+
+class TestTileFetcherSubdomains(unittest.TestCase):
+    def test_subdomains(self):
+        renderer = TileFetcher(url_pattern='http://{s}.example.com/{zoom}/{x}/{y}.png', subdomains=['t0', 't1'])
+        self.assertEqual(renderer._tile_url(0, 0, 1), 'http://t0.example.com/1/0/0.png')
+        self.assertEqual(renderer._tile_url(1, 0, 1), 'http://t1.example.com/1/1/0.png')
+        self.assertEqual(renderer._tile_url(1, 1, 1), 'http://t0.example.com/1/1/1.png')
+
+        # wrapped tiles map to the same host as the tile they wrap to
+        self.assertEqual(renderer._tile_url(-1, 0, 1), renderer._tile_url(1, 0, 1))
+
+    def test_default_subdomains(self):
+        renderer = TileFetcher(url_pattern='http://{s}.example.com/{zoom}/{x}/{y}.png')
+        hosts = set(renderer._tile_url(x, 0, 2).split('/')[2] for x in range(4))
+        self.assertEqual(hosts, set(['a.example.com', 'b.example.com', 'c.example.com']))
+
+class TestTileFetcherDeadline(unittest.TestCase):
+    def test_deadline(self):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 256, 256)
+        cr = cairo.Context(surface)
+        set_geo_transform(cr, -20037508.34, 20037508.34, 20037508.34, -20037508.34, 256, 256)
+
+        release = threading.Event()
+        def fetcher(url):
+            # the top-left tile is stuck
+            if url == 'test://1/0/0':
+                release.wait()
+            return solid_tile_data((1,0,0,1))
+
+        missed = []
+        renderer = TileFetcher(url_pattern='test://{zoom}/{x}/{y}', url_fetcher=fetcher, tile_size=(128, 128),
+                surface_cache=SurfaceCache(), fetch_pool=FetchPool(), deadline=0.2,
+                missed_tile_callback=missed.extend)
+        renderer.render_callable(cr)()
+        release.set()
+        output_surface(surface, 'tilefetcher_deadline')
+
+        self.assertEqual(missed, [(0, 0, 1)])
+        data = np.frombuffer(surface.get_data(), dtype=np.uint8).reshape((256, 256, 4))
+        self.assertTrue(np.all(data[128:,:,2] == 255))
+        self.assertTrue(np.all(data[:128,128:,2] == 255))
+        self.assertFalse(np.all(data[:128,:128,2] == 255))
+
+class TestSpatialReferencePairCache(unittest.TestCase):
+    def test_repeated_reprojection(self):
+        srs = SpatialReference()
+        srs.ImportFromEPSG(27700) # OSGB 1936
+
+        renderer = TileFetcher(url_pattern='test://{zoom}/{x}/{y}', url_fetcher=lambda url: solid_tile_data((1,0,0,1)),
+                surface_cache=SurfaceCache())
+
+        cache = spatial_reference_pair_cache()
+        cache.clear()
+        for _ in range(4):
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 64, 64)
+            cr = cairo.Context(surface)
+            set_geo_transform(cr, 400000, 600000, 400000, 200000, 64, 64)
+            renderer.render_callable(cr, spatial_reference=srs)()
+
+        stats = cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 3)
+
+        # the reprojected output is red within England
+        data = np.frombuffer(surface.get_data(), dtype=np.uint8).reshape((64, 64, 4))
+        self.assertTrue(np.all(data[16:48,16:48,2] == 255))
+
+def render_reprojected_gradient(warp_engine=None, max_intermediate_bytes=None, buffer_pool=None, transposed=False):
+    """Render a tile with a smooth gradient reprojected to the British national grid and return the output as an
+    array. If *transposed* is True, the directions of the red and green gradients are swapped.
+
+    """
+    srs = SpatialReference()
+    srs.ImportFromEPSG(27700) # OSGB 1936
+
+    # a tile with a smooth gradient so that differences in resampling show
+    pixels = np.zeros((256, 256, 4), dtype=np.uint8)
+    pixels[:,:,0] = np.arange(256)[np.newaxis,:]
+    pixels[:,:,1] = np.arange(256)[:,np.newaxis]
+    if transposed:
+        pixels[:,:,:2] = pixels[:,:,1::-1].copy()
+    pixels[:,:,3] = 255
+    output = StringIO.StringIO()
+    Image.fromarray(pixels, 'RGBA').save(output, 'png')
+    data = output.getvalue()
+
+    renderer = TileFetcher(url_pattern='test://{zoom}/{x}/{y}', url_fetcher=lambda url: data,
+            surface_cache=SurfaceCache())
+    renderer.warp_engine = warp_engine
+    renderer.max_intermediate_bytes = max_intermediate_bytes
+    renderer.buffer_pool = buffer_pool
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 64, 64)
+    cr = cairo.Context(surface)
+    set_geo_transform(cr, 400000, 600000, 400000, 200000, 64, 64)
+    renderer.render_callable(cr, spatial_reference=srs)()
+    return np.frombuffer(surface.get_data(), dtype=np.uint8).reshape((64, 64, 4)).astype(np.float64)
+
+class TestWarpEngines(unittest.TestCase):
+    def render(self, warp_engine):
+        return render_reprojected_gradient(warp_engine=warp_engine)
+
+    def test_grid_matches_reproject_image(self):
+        expected = self.render(ReprojectImageEngine())
+        output = self.render(WarpGridEngine())
+        self.assertLess(np.abs(output - expected)[8:56,8:56].mean(), 2.0)
+        self.assertTrue(np.all(output[8:56,8:56,3] == expected[8:56,8:56,3]))
+
+    def test_gdal_warp_matches_reproject_image(self):
+        try:
+            engine = GDALWarpEngine(num_threads=2, warp_memory_limit=16)
+        except RuntimeError:
+            raise unittest.SkipTest('gdal.Warp is not available')
+        expected = self.render(ReprojectImageEngine())
+        output = self.render(engine)
+        self.assertLess(np.abs(output - expected)[8:56,8:56].mean(), 1.0)
+
+        # the alpha band is warped rather than left transparent
+        self.assertTrue(np.all(expected[8:56,8:56,3] == 255))
+        self.assertTrue(np.all(output[8:56,8:56,3] == expected[8:56,8:56,3]))
+
+    def test_grid_is_reused(self):
+        engine = WarpGridEngine()
+        first = self.render(engine)
+        second = self.render(engine)
+        self.assertEqual(len(engine._grids), 1)
+        self.assertTrue(np.all(first == second))
+
+    def warp_adjacent(self, engine, left, width):
+        """Warp a gradient in spherical mercator covering England into an output in the British national grid with 1km
+        pixels whose left edge is at *left*.
+
+        """
+        bng = SpatialReference()
+        bng.ImportFromEPSG(27700) # OSGB 1936
+        mercator = SpatialReference()
+        mercator.ImportFromEPSG(3857)
+        pair = spatial_reference_pair_cache().get(bng, mercator)
+
+        driver = gdal.GetDriverByName('MEM')
+        source = driver.Create('', 256, 256, 1, gdal.GDT_Byte)
+        source.SetGeoTransform((-700000.0, 6000.0, 0.0, 7600000.0, 0.0, -6000.0))
+        source.GetRasterBand(1).WriteArray(((np.arange(256)[np.newaxis,:] + np.arange(256)[:,np.newaxis]) // 2)
+                .astype(np.uint8))
+
+        output = driver.Create('', width, 64, 1, gdal.GDT_Byte)
+        output.SetGeoTransform((left, 1000.0, 0.0, 400000.0, 0.0, -1000.0))
+        engine.warp(source, output, pair, gdal.GRA_Bilinear)
+        return output.ReadAsArray()
+
+    def test_grid_is_shared_between_adjacent_outputs(self):
+        engine = WarpGridEngine()
+        left = self.warp_adjacent(engine, 300000.0, 64)
+        right = self.warp_adjacent(engine, 364000.0, 64)
+        self.assertEqual(len(engine._grids), 1)
+        self.assertTrue(np.all(left > 0))
+
+        whole = self.warp_adjacent(engine, 300000.0, 128)
+        self.assertEqual(len(engine._grids), 1)
+        self.assertTrue(np.all(whole[:,:64] == left))
+        self.assertTrue(np.all(whole[:,64:] == right))
+
+    def test_grid_cache_is_bounded_by_bytes(self):
+        # each 64x64 frame holds two 32KiB arrays and so only one fits
+        engine = WarpGridEngine(frame_size=64, max_bytes=100*1024)
+        self.warp_adjacent(engine, 300000.0, 128)
+        self.assertEqual(len(engine._grids), 1)
+        self.assertEqual(engine._size, 64*1024)
+
+class TestConcurrentReprojection(unittest.TestCase):
+    def test_stress(self):
+        expected = render_reprojected_gradient()
+
+        outputs, errors = [], []
+        def render():
+            try:
+                for _ in range(4):
+                    outputs.append(render_reprojected_gradient())
+            except Exception as e: # pragma: no coverage
+                errors.append(e)
+
+        threads = [threading.Thread(target=render) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(outputs), 8 * 4)
+        for output in outputs:
+            self.assertTrue(np.all(output == expected))
+
+class TestBufferPool(unittest.TestCase):
+    def test_reuse(self):
+        pool = BufferPool()
+        surface = pool.acquire_image_surface(16, 16)
+        pool.release_image_surface(surface)
+        self.assertIs(pool.acquire_image_surface(16, 16), surface)
+        self.assertIsNot(pool.acquire_image_surface(16, 16), surface)
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.misses, 2)
+
+    def test_cleared_on_acquire(self):
+        pool = BufferPool()
+        dataset = pool.acquire_mem_dataset(8, 8, 4, gdal.GDT_Byte)
+        dataset.GetRasterBand(1).Fill(255)
+        pool.release_mem_dataset(dataset)
+        dataset = pool.acquire_mem_dataset(8, 8, 4, gdal.GDT_Byte)
+        self.assertEqual(dataset.ReadAsArray().max(), 0)
+
+    def test_byte_limit(self):
+        pool = BufferPool(max_bytes=3 * 16 * 16 * 4)
+        surfaces = [pool.acquire_image_surface(16, 16) for _ in range(4)]
+        for surface in surfaces:
+            pool.release_image_surface(surface)
+        self.assertEqual(pool.stats()['entries'], 3)
+        self.assertEqual(pool.size, 3 * 16 * 16 * 4)
+
+        # the least recently released surface was discarded
+        reused = [pool.acquire_image_surface(16, 16) for _ in range(3)]
+        self.assertNotIn(surfaces[0], reused)
+
+    def test_reprojection_reuses_buffers(self):
+        pool = BufferPool()
+        first = render_reprojected_gradient(buffer_pool=pool)
+        misses = pool.misses
+        second = render_reprojected_gradient(buffer_pool=pool)
+        self.assertEqual(pool.misses, misses)
+        self.assertGreater(pool.hits, 0)
+        self.assertTrue(np.all(first == second))
+
+    def test_reused_buffers_are_not_stale(self):
+        pool = BufferPool()
+        first = render_reprojected_gradient(buffer_pool=pool)
+        second = render_reprojected_gradient(buffer_pool=pool, transposed=True)
+        self.assertGreater(pool.hits, 0)
+
+        # the second render matches one through a fresh pool and not the first render
+        expected = render_reprojected_gradient(buffer_pool=BufferPool(), transposed=True)
+        self.assertTrue(np.all(second == expected))
+        self.assertFalse(np.all(second == first))
+
+class TestReadIntoImageSurface(unittest.TestCase):
+    def test_band_order(self):
+        dataset = gdal.GetDriverByName('MEM').Create('', 5, 3, 4, gdal.GDT_Byte)
+        for band_idx, value in enumerate((10, 20, 30, 255)):
+            dataset.GetRasterBand(band_idx+1).Fill(value)
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 5, 3)
+        read_into_image_surface(dataset, surface)
+        data = np.frombuffer(surface.get_data(), dtype=np.uint8).reshape((3, 5, 4))
+        self.assertTrue(np.all(data == [10, 20, 30, 255]))
+
+        # RGBA bands are swizzled into Cairo's BGRA order
+        read_into_image_surface(dataset, surface, (3, 2, 1, 4))
+        data = np.frombuffer(surface.get_data(), dtype=np.uint8).reshape((3, 5, 4))
+        self.assertTrue(np.all(data == [30, 20, 10, 255]))
+
+class _RecordingWarpEngine(ReprojectImageEngine):
+    def __init__(self):
+        self.calls = 0
+
+    def warp(self, *args, **kwargs):
+        self.calls += 1
+        return super(_RecordingWarpEngine, self).warp(*args, **kwargs)
+
+class TestIntermediateBlocks(unittest.TestCase):
+    def test_blocks_match_single_intermediate(self):
+        expected = render_reprojected_gradient()
+
+        # an intermediate of 64x64 pixels needs 16KiB and so this splits the output into at least 16 blocks
+        engine = _RecordingWarpEngine()
+        output = render_reprojected_gradient(warp_engine=engine, max_intermediate_bytes=1024)
+        self.assertGreaterEqual(engine.calls, 16)
+
+        self.assertTrue(np.all(output[:,:,3] == 255))
+        self.assertLess(np.abs(output - expected).mean(), 2.0)
+
+class TestAffineShortcut(unittest.TestCase):
+    def test_offset_mercator_is_not_warped(self):
+        # spherical mercator shifted by a false easting and northing is an affine transform of the native one
+        srs = SpatialReference()
+        srs.ImportFromProj4('+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=1000.0 +y_0=-2000.0 +k=1.0 '
+                '+units=m +nadgrids=@null +wktext +over +no_defs')
+
+        renderer = TileFetcher(url_pattern='test://{zoom}/{x}/{y}', url_fetcher=lambda url: solid_tile_data((1,0,0,1)),
+                surface_cache=SurfaceCache())
+        renderer.warp_engine = _RecordingWarpEngine()
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 64, 64)
+        cr = cairo.Context(surface)
+        set_geo_transform(cr, -1000000, 1000000, 1000000, -1000000, 64, 64)
+        renderer.render_callable(cr, spatial_reference=srs)()
+
+        self.assertEqual(renderer.warp_engine.calls, 0)
+        data = np.frombuffer(surface.get_data(), dtype=np.uint8).reshape((64, 64, 4))
+        self.assertTrue(np.all(data[:,:,2] == 255))
+
+    def test_british_national_grid_is_warped(self):
+        srs = SpatialReference()
+        srs.ImportFromEPSG(27700) # OSGB 1936
+        mercator = SpatialReference()
+        mercator.ImportFromEPSG(3857)
+
+        pair = spatial_reference_pair_cache().get(srs, mercator)
+        self.assertIsNone(_affine_native_to_target_matrix(pair, (0, 0, 700000, 1300000), 1000))
+
+class TestMBTilesSource(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='mbtiles-')
+        self.path = os.path.join(self.directory, 'test.mbtiles')
+
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+        db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        db.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+        db.execute("INSERT INTO metadata VALUES ('name', 'test')")
+
+        # zoom 1 tiles are red at the top and blue at the bottom; tile rows are stored bottom-up
+        for x in range(2):
+            db.execute('INSERT INTO tiles VALUES (1, ?, 1, ?)', (x, sqlite3.Binary(solid_tile_data((1,0,0,1)))))
+            db.execute('INSERT INTO tiles VALUES (1, ?, 0, ?)', (x, sqlite3.Binary(solid_tile_data((0,0,1,1)))))
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_tile(self):
+        source = MBTilesSource(self.path)
+        self.assertEqual(source.metadata, {'name': 'test'})
+        self.assertEqual(source.get_tile(0, 0, 1), solid_tile_data((1,0,0,1)))
+        self.assertEqual(source.get_tile(1, 1, 1), solid_tile_data((0,0,1,1)))
+        self.assertTrue(source.get_tile(0, 0, 0) is None)
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, MBTilesSource, os.path.join(self.directory, 'missing.mbtiles'))
+
+    def test_render(self):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 256, 256)
+        cr = cairo.Context(surface)
+        set_geo_transform(cr, -20037508.34, 20037508.34, 20037508.34, -20037508.34, 256, 256)
+
+        renderer = TileFetcher(tile_source=MBTilesSource(self.path), tile_size=(128, 128),
+                surface_cache=SurfaceCache())
+        renderer.render_callable(cr)()
+        output_surface(surface, 'tilefetcher_mbtiles')
+
+        data = np.frombuffer(surface.get_data(), dtype=np.uint8).reshape((256, 256, 4))
+        self.assertTrue(np.all(data[:128,:,2] == 255))
+        self.assertTrue(np.all(data[128:,:,0] == 255))
+
 class TestGeometry(unittest.TestCase):
     def test_default(self):
         renderer = Geometry()
@@ -274,6 +1088,28 @@ class TestGeometry(unittest.TestCase):
         output_surface(surface, 'geometryrenderer_multipoints')
         self.assertEqual(surface_hash(surface)/10, 53314)
 
+    def test_points_outside_clip_are_culled(self):
+        geom = IterableGeometry([
+            Point(0, 0),
+            MultiPoint([Point(-200, 0), Point(45, 45), Point(0, 120)]),
+            Point(179, -89),
+            Point(170, 100),
+        ])
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 360, 180)
+        cr = cairo.Context(surface)
+        set_geo_transform(cr, -180, 180, 90, -90, 360, 180)
+        scale = max(cr.device_to_user_distance(1,1))
+
+        srs = SpatialReference()
+        srs.ImportFromEPSG(4326) # WGS84 lat/long
+
+        rendered = []
+        renderer = Geometry(geom=geom, marker_radius=5*scale)
+        renderer._render_point = lambda p, context: rendered.append((p.x, p.y))
+        renderer.render_callable(cr, spatial_reference=srs)()
+        self.assertEqual(rendered, [(0, 0), (45, 45), (179, -89)])
+
     def test_linestrings(self):
         geom = IterableGeometry([
             LineString([
@@ -0,0 +1,53 @@
+import unittest
+
+from osgeo.osr import SpatialReference
+
+from foldbeam.rendering.srs import SpatialReferenceRegistry
+
+class TestSpatialReferenceRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = SpatialReferenceRegistry()
+
+    def test_interning(self):
+        bng = self.registry.from_epsg(27700)
+        self.assertIs(self.registry.from_epsg(27700), bng)
+        self.assertIs(self.registry.from_user_input('EPSG:27700'), bng)
+
+        other = SpatialReference()
+        other.ImportFromEPSG(27700)
+        self.assertIsNot(other, bng)
+        self.assertIs(self.registry.intern(other), bng)
+        self.assertEqual(self.registry.key(other), self.registry.key(bng))
+        self.assertTrue(self.registry.is_same(other, bng))
+
+    def test_equivalent_definitions_share_a_key(self):
+        wgs84 = self.registry.from_epsg(4326)
+        proj4 = self.registry.from_proj4('+proj=longlat +datum=WGS84 +no_defs')
+        self.assertTrue(wgs84.IsSame(proj4))
+        self.assertEqual(self.registry.key(wgs84), self.registry.key(proj4))
+
+    def test_different(self):
+        bng = self.registry.from_epsg(27700)
+        wgs84 = self.registry.from_epsg(4326)
+        self.assertNotEqual(self.registry.key(bng), self.registry.key(wgs84))
+        self.assertFalse(self.registry.is_same(bng, wgs84))
+
+        # keys are usable as dictionary keys
+        d = { self.registry.key(bng): 'bng', self.registry.key(wgs84): 'wgs84' }
+        self.assertEqual(d[self.registry.key(self.registry.from_user_input('EPSG:4326'))], 'wgs84')
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.registry.from_user_input, 'not a spatial reference')
+
+    def test_bounded(self):
+        registry = SpatialReferenceRegistry(max_definitions=4, max_spatial_references=2)
+        bng = registry.from_epsg(27700)
+        bng_key = registry.key(bng)
+        registry.from_epsg(4326)
+        registry.from_epsg(3857)
+        self.assertEqual(len(registry._canonical), 2)
+        self.assertTrue(len(registry._keys_by_wkt) <= 4)
+
+        # a forgotten spatial reference is registered again
+        self.assertIsNot(registry.from_epsg(27700), bng)
+        self.assertEqual(registry.key(registry.from_epsg(27700)), bng_key)